@@ -11,18 +11,34 @@ import os
 import re
 import signal
 import sys
+import time
 import traceback
 import urllib.parse
 import logging
 import logging.config
 import datetime
-import hashlib
 from importlib import reload
-from io import BytesIO
-from PIL import Image
 
-import requests
-from nio import AsyncClient, InviteEvent, JoinError, RoomMessageText, MatrixRoom, LoginError, RoomMemberEvent, RoomVisibility, RoomPreset, RoomCreateError, RoomResolveAliasResponse, UploadError, UploadResponse, SyncError
+import aiohttp
+import httpx
+from nio import AsyncClient, Event, InviteEvent, JoinError, RoomMessageText, MatrixRoom, LoginError, RoomMemberEvent, RoomVisibility, RoomPreset, RoomCreateError, RoomResolveAliasResponse, UploadError, UploadResponse, SyncError, SyncResponse, ErrorResponse, UnknownAccountDataEvent
+
+from modules.common.blocking import BlockingRunner
+from modules.common.commandqueue import CommandQueue
+from modules.common.directrooms import DirectRooms
+from modules.common.eventrouter import EventRouter
+from modules.common.httpcache import HttpCache
+from modules.common.httpclient import HttpClient
+from modules.common.imagestream import ImageStream, ImageTooLarge, image_size
+from modules.common.lazymodule import LazyModule, ModuleManifest
+from modules.common.mediacache import MediaCache
+from modules.common.metrics import Metrics
+from modules.common.module import BotModule
+from modules.common.pollscheduler import PollScheduler
+from modules.common.reply import Reply
+from modules.common.sendqueue import SendQueue
+from modules.common.statestore import StateStore
+from modules.common.watchdog import Watchdog
 
 # Couple of custom exceptions
 
@@ -39,6 +55,12 @@ class CommandRequiresOwner(Exception):
 
 
 class Bot:
+    word_re = re.compile(r'\w+')
+    non_word_re = re.compile(r'\W+')
+    # Timeline events always synced when SYNC_FILTER is used. State events are included to keep room state up to date.
+    core_event_types = ['m.room.message', 'm.room.encrypted', 'm.room.member', 'm.room.create', 'm.room.power_levels',
+                        'm.room.name', 'm.room.topic', 'm.room.avatar', 'm.room.canonical_alias', 'm.room.join_rules',
+                        'm.room.guest_access', 'm.room.history_visibility', 'm.room.encryption', 'm.room.tombstone']
 
     def __init__(self):
         self.appid = 'org.vranki.hemppa'
@@ -47,10 +69,41 @@ class Bot:
         self.join_on_invite = False
         self.modules = dict()
         self.module_aliases = dict()
+        self.commands = dict()  # '!command' -> (command, module), see update_commands()
+        self.event_router = EventRouter()
+        self.command_queue = CommandQueue(max_running=int(os.getenv('COMMAND_CONCURRENCY', 8)),
+                                          max_room_queue=int(os.getenv('COMMAND_ROOM_QUEUE', 20)),
+                                          max_user_queue=int(os.getenv('COMMAND_USER_QUEUE', 5)))
         self.leave_empty_rooms = True
-        self.uri_cache = dict()
-        self.pollcount = 0
+        self.media_cache = None
+        self.http_client = None
+        self.send_queue = None
+        self.direct_rooms = None
+        self.direct_rooms_loaded = False  # True when m.direct has been received, and can be updated
+        self.direct_room_creates = dict()  # User id -> room creation task, for rooms being created
+        self.state_store = None
+        self.filter_event_types = os.getenv('SYNC_FILTER', 'false').lower() == 'true'
+        self.lazy_load_members = os.getenv('LAZY_LOAD_MEMBERS', 'false').lower() == 'true'
+        self.lazy_modules = os.getenv('LAZY_MODULES', 'true').lower() == 'true'
+        self.module_watch = float(os.getenv('MODULE_WATCH', 0))  # Seconds between checking module files, 0 = off
+        self.watch_task = None
+        self.sync_filter = None
+        if self.filter_event_types or self.lazy_load_members:
+            self.sync_filter = {'room': {'state': {}, 'timeline': {}}}
+        if self.filter_event_types:
+            # Bot doesn't use presence, typing notifications or read receipts
+            self.sync_filter['presence'] = {'not_types': ['*']}
+            self.sync_filter['room']['ephemeral'] = {'not_types': ['*']}
+        if self.lazy_load_members:
+            self.sync_filter['room']['state']['lazy_load_members'] = True
+        self.image_uploads = dict()  # url -> upload task, for uploads in progress
+        self.image_max_size = 50 * 1024 * 1024  # Bytes
         self.poll_task = None
+        self.poll_scheduler = PollScheduler()
+        self.poll_wakeup = asyncio.Event()  # Set when the poll schedule changes
+        self.poll_timeout = int(os.getenv('POLL_TIMEOUT', 60))  # Seconds
+        self.poll_tasks = dict()  # Module name -> running matrix_poll task
+        self.poll_stats = dict()  # Module name -> poll statistics
         self.owners = []
         self.debug = os.getenv("DEBUG", "false").lower() == "true"
         self.logger = None
@@ -58,6 +111,21 @@ class Bot:
         self.jointime = None  # HACKHACKHACK to avoid running old commands after join
         self.join_hack_time = 5  # Seconds
 
+        self.settings_dirty = False
+        self.settings_task = None
+        self.settings_flush = asyncio.Event()
+        self.settings_save_delay = 2  # Seconds to wait for more changes before writing settings
+        self.saved_settings = dict()  # Settings key -> JSON last written to or read from account data
+        self.legacy_settings = None  # Settings from the old single account data event, until migrated
+
+        self.metrics = Metrics()
+        self.metrics_addr = os.getenv('METRICS_ADDR', '127.0.0.1')
+        self.metrics_port = os.getenv('METRICS_PORT')  # Metrics are served only if set
+        self.last_sync = None  # Loop time of last sync response
+        self.watchdog = None
+        self.watchdog_threshold = float(os.getenv('WATCHDOG_THRESHOLD', 1))  # Seconds, 0 = off
+        self.setup_metrics()
+
         self.initialize_logger()
 
     def initialize_logger(self):
@@ -78,6 +146,91 @@ class Bot:
 
         self.logger.debug("Logger initialized")
 
+    def setup_metrics(self):
+        describe = self.metrics.describe
+        describe('hemppa_command_duration_seconds', 'histogram', 'Time spent running commands, by module')
+        describe('hemppa_command_errors_total', 'counter', 'Commands that failed with an exception, by module')
+        describe('hemppa_poll_duration_seconds', 'histogram', 'Time spent in matrix_poll, by module')
+        describe('hemppa_poll_errors_total', 'counter', 'Polls that failed with an exception, by module')
+        describe('hemppa_poll_timeouts_total', 'counter', 'Polls cancelled after POLL_TIMEOUT, by module')
+        describe('hemppa_poll_skipped_total', 'counter', 'Polls skipped as previous poll was still running, by module')
+        describe('hemppa_syncs_total', 'counter', 'Sync responses received')
+        describe('hemppa_sync_age_seconds', 'gauge', 'Seconds since last sync response')
+        describe('hemppa_sync_event_delay_seconds', 'histogram', 'Time from server receiving an event to bot syncing it')
+        describe('hemppa_send_duration_seconds', 'histogram', 'Time to send an event, including queueing and retries')
+        describe('hemppa_send_errors_total', 'counter', 'Events that could not be sent')
+        describe('hemppa_send_queued', 'gauge', 'Events waiting to be sent')
+        describe('hemppa_send_rate_limited_total', 'counter', 'Rate limited responses from homeserver')
+        describe('hemppa_send_retries_total', 'counter', 'Retried event sends')
+        describe('hemppa_commands_running', 'gauge', 'Commands running')
+        describe('hemppa_commands_queued', 'gauge', 'Commands waiting to run')
+        describe('hemppa_commands_rejected_total', 'counter', 'Commands rejected as queues were full')
+        describe('hemppa_settings_writes_total', 'counter', 'Module settings written to account data')
+        describe('hemppa_settings_written_bytes_total', 'counter', 'Bytes of module settings written to account data')
+        describe('hemppa_media_cache_entries', 'gauge', 'Images in media cache')
+        describe('hemppa_media_cache_bytes', 'gauge', 'Total size of images in media cache')
+        describe('hemppa_media_cache_hits_total', 'counter', 'Media cache hits')
+        describe('hemppa_media_cache_misses_total', 'counter', 'Media cache misses')
+        describe('hemppa_media_cache_hit_ratio', 'gauge', 'Media cache hits / lookups')
+        describe('hemppa_http_cache_entries', 'gauge', 'Responses in HTTP cache')
+        describe('hemppa_http_cache_bytes', 'gauge', 'Total size of responses in HTTP cache')
+        describe('hemppa_http_cache_hits_total', 'counter', 'HTTP requests answered from cache')
+        describe('hemppa_http_cache_misses_total', 'counter', 'Cached HTTP requests sent to the server')
+        describe('hemppa_http_cache_revalidations_total', 'counter', 'Cached HTTP responses the server said were not modified')
+        describe('hemppa_event_duration_seconds_total', 'counter', 'Time spent handling events, by subscriber')
+        describe('hemppa_events_total', 'counter', 'Events handled, by subscriber')
+        describe('hemppa_event_loop_lag_seconds', 'histogram', 'How late the event loop wakes up, time it was blocked')
+        describe('hemppa_event_loop_blocked_seconds_total', 'counter', 'Total time the event loop was blocked')
+        describe('hemppa_modules_enabled', 'gauge', 'Enabled modules')
+        describe('hemppa_stalls_total', 'counter', 'Times the event loop was blocked over WATCHDOG_THRESHOLD, by module')
+        describe('hemppa_stall_seconds_total', 'counter', 'Time the event loop was blocked in stalls, by module')
+        self.metrics.add_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        """Metrics collector for statistics kept elsewhere"""
+        samples = [('hemppa_modules_enabled', None, sum(1 for module in self.modules.values() if module.enabled))]
+        if self.last_sync is not None:
+            samples.append(('hemppa_sync_age_seconds', None, asyncio.get_event_loop().time() - self.last_sync))
+        for modulename, stats in self.poll_stats.items():
+            labels = {'module': modulename}
+            samples.append(('hemppa_poll_errors_total', labels, stats['errors']))
+            samples.append(('hemppa_poll_timeouts_total', labels, stats['timeouts']))
+            samples.append(('hemppa_poll_skipped_total', labels, stats['skipped']))
+        commands = self.command_queue.stats()
+        samples.append(('hemppa_commands_running', None, commands['running']))
+        samples.append(('hemppa_commands_queued', None, commands['queued']))
+        samples.append(('hemppa_commands_rejected_total', None, commands['rejected']))
+        if self.send_queue:
+            sending = self.send_queue.stats()
+            samples.append(('hemppa_send_queued', None, sending['queued']))
+            samples.append(('hemppa_send_rate_limited_total', None, sending['rate_limited']))
+            samples.append(('hemppa_send_retries_total', None, sending['retries']))
+        if self.media_cache:
+            cache = self.media_cache.stats()
+            lookups = cache['hits'] + cache['misses']
+            samples.append(('hemppa_media_cache_entries', None, cache['entries']))
+            samples.append(('hemppa_media_cache_bytes', None, cache['bytes']))
+            samples.append(('hemppa_media_cache_hits_total', None, cache['hits']))
+            samples.append(('hemppa_media_cache_misses_total', None, cache['misses']))
+            samples.append(('hemppa_media_cache_hit_ratio', None, cache['hits'] / lookups if lookups else 0.0))
+        if self.http_client and self.http_client.cache:
+            cache = self.http_client.cache.stats()
+            samples.append(('hemppa_http_cache_entries', None, cache['entries']))
+            samples.append(('hemppa_http_cache_bytes', None, cache['bytes']))
+            samples.append(('hemppa_http_cache_hits_total', None, cache['hits']))
+            samples.append(('hemppa_http_cache_misses_total', None, cache['misses']))
+            samples.append(('hemppa_http_cache_revalidations_total', None, cache['revalidations']))
+        for module, name, count, errors, average, maximum in self.event_router.stats():
+            labels = {'module': module, 'subscriber': name}
+            samples.append(('hemppa_events_total', labels, count))
+            samples.append(('hemppa_event_duration_seconds_total', labels, average * count))
+        return samples
+
+    def on_stall(self, module, seconds, stack):
+        labels = {'module': module or 'core'}
+        self.metrics.inc('hemppa_stalls_total', labels=labels)
+        self.metrics.inc('hemppa_stall_seconds_total', seconds, labels)
+
     def get_uri_cache(self, url, blob=False):
         """
 
@@ -87,9 +240,9 @@ class Bot:
         """
         cache_key = url
         if blob:  ## url is bytes, cannot be used a key for cache
-            cache_key = hashlib.md5(url).hexdigest()
+            cache_key = MediaCache.blob_key(url)
 
-        return self.uri_cache.get(cache_key)
+        return self.media_cache.get(cache_key)
 
 
     async def upload_and_send_image(self, room, url, text=None, blob=False, blob_content_type="image/png", no_cache=False):
@@ -137,45 +290,105 @@ class Bot:
 
         cache_key = url_or_bytes
         if blob:  ## url is bytes, cannot be used a key for cache
-            cache_key = hashlib.md5(url_or_bytes).hexdigest()
+            cache_key = MediaCache.blob_key(url_or_bytes)
 
         if no_cache:
             cache_key = None
 
         if blob:
-            i = Image.open(BytesIO(url_or_bytes))
+            w, h = image_size(url_or_bytes)
             image_length = len(url_or_bytes)
-            content_type = blob_content_type
             (response, alist) = await self.client.upload(lambda a, b: url_or_bytes, blob_content_type, filesize=image_length)
+            res = self.__upload_result(response, blob_content_type, w, h, image_length)
         else:
-            self.logger.debug(f"start downloading image from url {url_or_bytes}")
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            url_response = requests.get(url_or_bytes, headers=headers)
-            self.logger.debug(f"response [status_code={url_response.status_code}, headers={url_response.headers}")
+            # Share the upload if the same url is already being uploaded
+            upload = self.image_uploads.get(url_or_bytes)
+            if not upload:
+                upload = asyncio.get_event_loop().create_task(self.upload_image_from_url(url_or_bytes))
+                self.image_uploads[url_or_bytes] = upload
+                upload.add_done_callback(lambda task: self.image_uploads.pop(url_or_bytes, None))
+            res = await asyncio.shield(upload)
+
+        if cache_key:
+            self.media_cache.put(cache_key, res)
+        return res
+
+    async def upload_image_from_url(self, url):
+        self.logger.debug(f"start downloading image from url {url}")
+        headers = {'User-Agent': 'Mozilla/5.0'}
+        try:
+            async with self.http_client.stream('GET', url, headers=headers) as url_response:
+                self.logger.debug(f"response [status_code={url_response.status_code}, headers={url_response.headers}")
+                if url_response.status_code != 200:
+                    self.logger.error("unable to request url: %s", url_response)
+                    raise UploadFailed
 
-            if url_response.status_code == 200:
                 content_type = url_response.headers.get("content-type")
-                self.logger.info(f"uploading content to matrix server [size={len(url_response.content)}, content-type: {content_type}]")
-                (response, alist) = await self.client.upload(lambda a, b: url_response.content, content_type)
-                self.logger.debug("response: %s", response)
-                i = Image.open(BytesIO(url_response.content))
-                image_length = len(url_response.content)
-            else:
-                self.logger.error("unable to request url: %s", url_response)
-                raise UploadFailed
+                content_length = url_response.headers.get("content-length")
+                if content_length and int(content_length) > self.image_max_size:
+                    self.logger.error(f"image at {url} is too large to upload: {content_length} bytes")
+                    raise UploadFailed
 
+                stream = ImageStream(url_response, self.image_max_size)
+                try:
+                    if content_length and not url_response.headers.get("content-encoding"):
+                        image_length = int(content_length)
+                    else:
+                        # Upload needs to know the size beforehand
+                        await stream.read_all()
+                        image_length = stream.size
+                    self.logger.info(f"uploading content to matrix server [size={image_length}, content-type: {content_type}]")
+                    (response, alist) = await self.client.upload(stream.data_provider, content_type, filesize=image_length)
+                    self.logger.debug("response: %s", response)
+                finally:
+                    stream.close()
+        except ImageTooLarge:
+            self.logger.error(f"image at {url} is too large to upload, limit is {self.image_max_size} bytes")
+            raise UploadFailed
+        except httpx.HTTPError as e:
+            self.logger.error(f"unable to request url {url}: {repr(e)}")
+            raise UploadFailed
+
+        return self.__upload_result(response, content_type, stream.width, stream.height, image_length)
+
+    def __upload_result(self, response, content_type, w, h, image_length):
         if isinstance(response, UploadResponse):
             self.logger.info("uploaded file to %s", response.content_uri)
-            res = [response.content_uri, content_type, i.size[0], i.size[1], image_length]
-            if cache_key:
-                self.uri_cache[cache_key] = res
-            return res
-        else:
-            response: UploadError
-            self.logger.error("unable to upload file. msg: %s", response.message)
-
+            return [response.content_uri, content_type, w, h, image_length]
+        response: UploadError
+        self.logger.error("unable to upload file. msg: %s", response.message)
         raise UploadFailed
 
+    async def send_event(self, room, message_type, content):
+        """Send an event to room through the send queue, which paces sending and retries if rate limited
+
+        :param room: A MatrixRoom the event should be send to
+        :param message_type: Event type, e.g. m.room.message
+        :param content: Event content
+        :return: the NIO Response from room_send()
+        """
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        try:
+            response = await self.send_queue.send(room.room_id, message_type, content)
+        except Exception:
+            self.metrics.inc('hemppa_send_errors_total')
+            raise
+        self.metrics.observe('hemppa_send_duration_seconds', loop.time() - start)
+        if isinstance(response, ErrorResponse):
+            self.metrics.inc('hemppa_send_errors_total')
+        return response
+
+    def reply(self, room, msgtype="m.notice", bot_ignore=False):
+        """Start a reply to room that is collected from several parts and sent as few messages as possible
+
+        :param room: A MatrixRoom the reply should be send to
+        :param msgtype: The message type for the room https://matrix.org/docs/spec/client_server/latest#m-room-message-msgtypes
+        :param bot_ignore: Flag to mark the messages to be ignored by the bot
+        :return: a Reply, add parts with text(), html() and image(), and send with send()
+        """
+        return Reply(self, room, msgtype, bot_ignore)
+
     async def send_text(self, room, body, msgtype="m.notice", bot_ignore=False):
         """
 
@@ -193,7 +406,7 @@ class Bot:
         if bot_ignore:
             msg["org.vranki.hemppa.ignore"] = "true"
 
-        return await self.client.room_send(room.room_id, 'm.room.message', msg)
+        return await self.send_event(room, 'm.room.message', msg)
 
     async def send_html(self, room, html, plaintext, msgtype="m.notice", bot_ignore=False):
         """
@@ -214,7 +427,7 @@ class Bot:
         }
         if bot_ignore:
             msg["org.vranki.hemppa.ignore"] = "true"
-        await self.client.room_send(room.room_id, 'm.room.message', msg)
+        return await self.send_event(room, 'm.room.message', msg)
 
     async def send_location(self, room, body, latitude, longitude, bot_ignore=False):
         """
@@ -232,7 +445,7 @@ class Bot:
             "geo_uri": 'geo:' + str(latitude) + ',' + str(longitude),
             "msgtype": "m.location",
             }
-        await self.client.room_send(room.room_id, 'm.room.message', locationmsg)
+        return await self.send_event(room, 'm.room.message', locationmsg)
 
     async def send_image(self, room, url, body, mimetype=None, width=None, height=None, size=None):
         """
@@ -265,7 +478,7 @@ class Bot:
         if size:
             msg["info"]["size"] = size
 
-        return await self.client.room_send(room.room_id, 'm.room.message', msg)
+        return await self.send_event(room, 'm.room.message', msg)
 
     async def set_room_avatar(self, room, uri, mimetype=None, width=None, height=None, size=None):
         """
@@ -317,24 +530,57 @@ class Bot:
 
     async def find_or_create_private_msg(self, mxid, roomname):
         # Find if we already have a common room with user:
-        msg_room = None
-        for croomid in self.client.rooms:
-            roomobj = self.client.rooms[croomid]
-            if len(roomobj.users) == 2:
-                for user in roomobj.users:
-                    if user == mxid:
-                        msg_room = roomobj
-
-        # Nope, let's create one
-        if not msg_room:
-            msg_room = await self.client.room_create(visibility=RoomVisibility.private,
-                name=roomname,
-                is_direct=True,
-                preset=RoomPreset.private_chat,
-                invite={mxid},
-            )
+        msg_room = self.direct_rooms.get(mxid, self.client.rooms)
+        if msg_room:
+            return msg_room
+
+        # Nope, let's create one. Share the room if one is already being created for the user.
+        create = self.direct_room_creates.get(mxid)
+        if not create:
+            create = asyncio.get_event_loop().create_task(self.create_private_msg(mxid, roomname))
+            self.direct_room_creates[mxid] = create
+            create.add_done_callback(lambda task: self.direct_room_creates.pop(mxid, None))
+        return await asyncio.shield(create)
+
+    async def create_private_msg(self, mxid, roomname):
+        msg_room = await self.client.room_create(visibility=RoomVisibility.private,
+            name=roomname,
+            is_direct=True,
+            preset=RoomPreset.private_chat,
+            invite={mxid},
+        )
+        if type(msg_room) is not RoomCreateError:
+            self.direct_rooms.add_direct(mxid, msg_room.room_id, msg_room)
+            # Remember the room in m.direct, so it's found even if the user doesn't join
+            if self.direct_rooms_loaded:
+                await self.set_account_data(self.direct_rooms.direct, 'm.direct')
         return msg_room
 
+    async def direct_cb(self, event):
+        if event.type == 'm.direct':
+            self.direct_rooms.load_direct(event.content)
+            # Not included in incremental syncs if it hasn't changed, so store it for restarts
+            self.state_store.set('m.direct', json.dumps(event.content))
+
+
+    def subscribe(self, callback, event_types, rooms=None, prefix=None, regex=None, owner=None):
+        """Subscribe callback(room, event) to room events. Prefer this over client.add_event_callback().
+
+        :param callback: async function called with MatrixRoom and event
+        :param event_types: nio event class (e.g. RoomMessageText), event type string, or a list of them
+        :param rooms: room ids to receive events from, None for all rooms
+        :param prefix: only receive events with body starting with this
+        :param regex: only receive events with body matching this regular expression
+        :param owner: name of the module subscribing, for statistics
+        :return: a Subscription, which can be passed to unsubscribe() and set_subscription_rooms()
+        """
+        return self.event_router.subscribe(callback, event_types, rooms, prefix, regex, owner)
+
+    def unsubscribe(self, subscription_or_callback):
+        self.event_router.unsubscribe(subscription_or_callback)
+
+    def set_subscription_rooms(self, subscription, rooms):
+        self.event_router.set_rooms(subscription, rooms)
 
     def remove_callback(self, callback):
         for cb_object in self.client.event_callbacks:
@@ -382,14 +628,111 @@ class Bot:
         return "org.vranki.hemppa.ignore" in event.source['content']
 
     def save_settings(self):
-        module_settings = dict()
+        """Schedule writing settings to account data
+
+        Settings are written in background after settings_save_delay seconds, so that a burst of
+        save_settings() calls results in a single write. Use flush_settings() to write immediately.
+        """
+        self.settings_dirty = True
+        if not self.settings_task or self.settings_task.done():
+            self.settings_task = asyncio.get_event_loop().create_task(self.settings_writer())
+
+    async def settings_writer(self):
+        try:
+            await asyncio.wait_for(self.settings_flush.wait(), self.settings_save_delay)
+        except asyncio.TimeoutError:
+            pass
+        self.settings_flush.clear()
+        try:
+            while self.settings_dirty:
+                if not await self.write_settings():
+                    break
+        except Exception:
+            self.logger.exception('unhandled exception while writing settings')
+
+    async def flush_settings(self):
+        """Write pending settings changes to account data now"""
+        if self.settings_task and not self.settings_task.done():
+            self.settings_flush.set()
+            await self.settings_task
+        elif self.settings_dirty:
+            await self.write_settings()
+
+    async def write_settings(self):
+        """Write settings of modules that have changed since last write, each to its own account data key"""
+        # Clear the flag before writing so that changes made during the write are saved again
+        self.settings_dirty = False
+        changed = dict()
         for modulename, moduleobject in self.modules.items():
             try:
-                module_settings[modulename] = moduleobject.get_settings()
+                changed[modulename] = json.dumps(moduleobject.get_settings(), sort_keys=True)
             except Exception:
                 self.logger.exception(f'unhandled exception {modulename}.get_settings')
-        data = {self.appid: self.version, 'module_settings': module_settings, 'uri_cache': self.uri_cache}
-        self.set_account_data(data)
+        if 'uri_cache' in self.saved_settings:
+            # uri cache has moved to media cache, empty the old event
+            changed['uri_cache'] = json.dumps({})
+        if self.legacy_settings:
+            # Carry over settings of modules that are not loaded right now
+            for modulename, data in self.legacy_settings.items():
+                if modulename not in changed:
+                    changed[modulename] = json.dumps(data, sort_keys=True)
+        changed = {name: data for name, data in changed.items() if self.saved_settings.get(name) != data}
+
+        names = list(changed)
+        results = await asyncio.gather(*[self.put_account_data(changed[name], self.settings_key(name)) for name in names])
+        for name, result in zip(names, results):
+            if result:
+                self.saved_settings[name] = changed[name]
+                self.metrics.inc('hemppa_settings_writes_total')
+                self.metrics.inc('hemppa_settings_written_bytes_total', len(changed[name]))
+            self.logger.debug(f'Wrote settings of {name}, {len(changed[name])} bytes')
+
+        if not all(results):
+            self.settings_dirty = True
+            return False
+
+        if self.legacy_settings is not None:
+            # Everything is now in per-module keys, drop the old monolithic event
+            if not await self.set_account_data({self.appid: self.version}):
+                self.settings_dirty = True
+                return False
+            self.logger.info('Migrated settings to per-module account data')
+            self.legacy_settings = None
+        return True
+
+    async def read_settings(self):
+        """Read settings of all modules from account data
+
+        :return: a dict with module_settings (module name -> settings) and uri_cache
+        """
+        # Make sure we read back what has been saved
+        await self.flush_settings()
+
+        data = {'module_settings': dict()}
+        legacy = await self.get_account_data()
+        if legacy and legacy.get('module_settings') is not None:
+            self.logger.info('Found settings in old format, migrating them to per-module account data')
+            self.legacy_settings = legacy['module_settings']
+            data['module_settings'].update(legacy['module_settings'])
+            data['uri_cache'] = legacy.get('uri_cache')
+
+        names = list(self.modules) + ['uri_cache']
+        results = await asyncio.gather(*[self.get_account_data(self.settings_key(name)) for name in names])
+        for name, result in zip(names, results):
+            if result is None:
+                continue
+            self.saved_settings[name] = json.dumps(result, sort_keys=True)
+            if name == 'uri_cache':
+                data['uri_cache'] = result
+            else:
+                data['module_settings'][name] = result
+
+        if self.legacy_settings is not None or data.get('uri_cache'):
+            self.save_settings()
+        return data
+
+    def settings_key(self, name):
+        return f'{self.appid}.{name}'
 
     def load_settings(self, data):
         if not data:
@@ -397,7 +740,8 @@ class Bot:
         if not data.get('module_settings'):
             return
         if data.get('uri_cache'):
-            self.uri_cache = data['uri_cache']
+            count = self.media_cache.import_entries(data['uri_cache'])
+            self.logger.info(f'Imported {count} entries from account data uri cache to media cache')
         for modulename, moduleobject in self.modules.items():
             if data['module_settings'].get(modulename):
                 try:
@@ -407,16 +751,26 @@ class Bot:
                     self.logger.exception(f'unhandled exception {modulename}.set_settings')
 
     async def message_cb(self, room, event):
+        body = event.body
+        # Most messages aren't commands, get rid of them as cheaply as possible
+        if body[:1] != '!':
+            return
+
         # Ignore if asked to ignore
         if self.should_ignore_event(event):
             if self.debug:
                 self.logger.debug('Ignoring event!')
             return
 
-        body = event.body
         # Figure out the command
-        if not self.starts_with_command(body):
-            return
+        token = body.split(None, 1)[0]
+        command, moduleobject = self.commands.get(token, (None, None))
+        if not moduleobject:
+            if not self.starts_with_command(body):
+                return
+            # Strip away non-alphanumeric characters, including leading ! for security
+            command = self.non_word_re.sub('', token)
+            command, moduleobject = self.commands.get('!' + command, (command, None))
 
         if self.owners_only and not self.is_owner(event):
             self.logger.info(f"Ignoring {event.sender}, because they're not an owner")
@@ -430,31 +784,48 @@ class Bot:
                 return
             self.jointime = None
 
-        command = body.split().pop(0)
-
-        # Strip away non-alphanumeric characters, including leading ! for security
-        command = re.sub(r'\W+', '', command)
-
-        # Fallback to any declared aliases
-        moduleobject = self.modules.get(command) or self.modules.get(self.module_aliases.get(command))
-
         if moduleobject is not None:
             if moduleobject.enabled:
-                try:
-                    await moduleobject.matrix_message(self, room, event)
-                except CommandRequiresAdmin:
-                    await self.send_text(room, f'Sorry, you need admin power level in this room to run that command.')
-                except CommandRequiresOwner:
-                    await self.send_text(room, f'Sorry, only bot owner can run that command.')
-                except Exception:
-                    await self.send_text(room, f'Module {command} experienced difficulty: {sys.exc_info()[0]} - see log for details')
-                    self.logger.exception(f'unhandled exception in !{command}')
+                # Run in background, commands in the same room are run in order
+                if not self.command_queue.submit(room.room_id, event.sender,
+                                                 functools.partial(self.run_command, command, moduleobject, room, event)):
+                    await self.send_text(room, f'Sorry, too many commands are waiting. Try again later.')
         else:
             self.logger.error(f"Unknown command: {command}")
             # TODO Make this configurable
             # await self.send_text(room,
             #                     f"Sorry. I don't know what to do. Execute !help to get a list of available commands.")
 
+    async def run_command(self, command, moduleobject, room, event):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        labels = {'module': moduleobject.name}
+        try:
+            await moduleobject.matrix_message(self, room, event)
+        except CommandRequiresAdmin:
+            await self.send_text(room, f'Sorry, you need admin power level in this room to run that command.')
+        except CommandRequiresOwner:
+            await self.send_text(room, f'Sorry, only bot owner can run that command.')
+        except Exception:
+            self.metrics.inc('hemppa_command_errors_total', labels=labels)
+            await self.send_text(room, f'Module {command} experienced difficulty: {sys.exc_info()[0]} - see log for details')
+            self.logger.exception(f'unhandled exception in !{command}')
+        finally:
+            self.metrics.observe('hemppa_command_duration_seconds', loop.time() - start, labels)
+
+    def update_commands(self):
+        """Rebuild the command dispatch table. Call after modules or aliases have changed."""
+        commands = dict()
+        for name, modulename in self.module_aliases.items():
+            moduleobject = self.modules.get(modulename)
+            if moduleobject and self.word_re.fullmatch(name):
+                commands['!' + name] = (name, moduleobject)
+        # Module names take precedence over aliases
+        for name, moduleobject in self.modules.items():
+            if moduleobject and self.word_re.fullmatch(name):
+                commands['!' + name] = (name, moduleobject)
+        self.commands = commands
+
     @staticmethod
     def starts_with_command(body):
         """Checks if body starts with ! and has one or more letters after it"""
@@ -476,7 +847,48 @@ class Bot:
         else:
             self.logger.warning(f'Received invite event, but not joining as sender is not owner or bot not configured to join on invite. {event}')
 
+    async def sync_cb(self, response):
+        self.state_store.save_sync(response, self.client.rooms)
+        self.last_sync = asyncio.get_event_loop().time()
+        self.metrics.inc('hemppa_syncs_total')
+        if self.poll_task:
+            # Started, so these are new events and not history from initial sync
+            now = time.time() * 1000
+            for join_info in response.rooms.join.values():
+                for event in join_info.timeline.events:
+                    if getattr(event, 'server_timestamp', None):
+                        self.metrics.observe('hemppa_sync_event_delay_seconds', max(now - event.server_timestamp, 0) / 1000)
+
+    async def sync_loop(self):
+        while True:
+            try:
+                await self.client.sync_forever(timeout=30000, sync_filter=self.sync_filter)
+            except (aiohttp.ClientError, asyncio.TimeoutError, TimeoutError) as e:
+                self.logger.warning(f'Sync failed, retrying in 10 seconds: {repr(e)}')
+                await asyncio.sleep(10)
+
+    async def sync_once(self, **kwargs):
+        """Sync once, retrying after network errors until it gets a response"""
+        while True:
+            try:
+                return await self.client.sync(**kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError, TimeoutError) as e:
+                self.logger.warning(f'Initial sync failed, retrying in 10 seconds: {repr(e)}')
+                await asyncio.sleep(10)
+
+    def update_sync_filter(self):
+        """Update sync filter with event types needed by enabled modules. Call after modules have changed."""
+        if not self.sync_filter or not self.filter_event_types:
+            return
+        types = set(self.core_event_types)
+        for moduleobject in self.modules.values():
+            if moduleobject and moduleobject.enabled:
+                types.update(moduleobject.sync_event_types())
+        # Filter is serialized again for each sync, so updating it in place is enough
+        self.sync_filter['room']['timeline']['types'] = sorted(types)
+
     async def memberevent_cb(self, room, event):
+        self.direct_rooms.update_room(room)
         # Automatically leaves rooms where bot is alone.
         if room.member_count == 1 and event.membership=='leave' and event.sender != self.matrix_user:
             self.logger.info(f"Membership event in {room.display_name} ({room.room_id}) with {room.member_count} members by '{event.sender}' (I am {self.matrix_user})- leaving room as i don't want to be left alone!")
@@ -493,62 +905,247 @@ class Bot:
             self.logger.exception(f'Module {modulename} failed to load')
             return None
 
-    def reload_modules(self):
+    def new_module(self, modulename):
+        """Load module, or return a LazyModule standing in for it if it can be loaded on first use"""
+        if self.lazy_modules and modulename != 'bot':
+            manifest = ModuleManifest.scan(modulename, os.path.join('modules', modulename + '.py'))
+            if manifest.lazy:
+                self.logger.info(f'Found module: {modulename}, loading it on first use')
+                return LazyModule(manifest, self.activate_module)
+        return self.load_module(modulename)
+
+    def activate_module(self, modulename):
+        """Load a module that is represented by a LazyModule, and put it in its place. Returns the module."""
+        lazy = self.modules.get(modulename)
+        if not isinstance(lazy, LazyModule):
+            return lazy
+        moduleobject = self.load_module(modulename)
+        if not moduleobject:
+            raise ImportError(f'Module {modulename} failed to load')
+        if lazy.settings:
+            try:
+                moduleobject.set_settings(lazy.settings)
+            except Exception:
+                self.logger.exception(f'unhandled exception {modulename}.set_settings')
+        # May have been enabled or disabled after settings were loaded
+        moduleobject.enabled = lazy.enabled
+        self.modules[modulename] = moduleobject
+        if lazy.started:
+            try:
+                moduleobject.matrix_start(self)
+            except Exception:
+                self.logger.exception(f'unhandled exception from {modulename}.matrix_start')
+        self.update_commands()
+        return moduleobject
+
+    async def reload_modules(self):
         for modulename in self.modules:
             self.logger.info(f'Reloading {modulename} ..')
-            self.modules[modulename] = self.load_module(modulename)
+            self.modules[modulename] = self.new_module(modulename)
+        self.update_commands()
+
+    def reload_module(self, modulename):
+        """Reload one module from its file and put it in place of the running module
+
+        The new module gets the settings of the old one, and the state returned by its get_state().
+        Other modules, polls and settings in account data are not touched.
+
+        :return: the new module
+        """
+        oldmodule = self.modules[modulename]
+        self.logger.info(f'Reloading {modulename} ..')
+        if isinstance(oldmodule, LazyModule):
+            # Not imported yet, just read the file again
+            newmodule = self.new_module(modulename)
+        else:
+            newmodule = self.load_module(modulename)
+        if not newmodule:
+            raise ImportError(f'Module {modulename} failed to load')
 
-        self.load_settings(self.get_account_data())
+        try:
+            state = oldmodule.get_state()
+        except Exception:
+            self.logger.exception(f'unhandled exception {modulename}.get_state')
+            state = None
+        try:
+            newmodule.set_settings(oldmodule.get_settings())
+            if state is not None:
+                newmodule.set_state(state)
+        except Exception:
+            self.logger.exception(f'unhandled exception setting settings and state of {modulename}')
+        newmodule.enabled = oldmodule.enabled
+
+        # Nothing else runs between stopping the old module and starting the new one,
+        # so events are handled by either one of them, never both or neither
+        if oldmodule.enabled:
+            try:
+                oldmodule.matrix_stop(self)
+            except Exception:
+                self.logger.exception(f'unhandled exception from {modulename}.matrix_stop')
+        # Drop subscriptions the old module didn't remove itself
+        self.event_router.unsubscribe_owner(modulename)
+        self.modules[modulename] = newmodule
+        if newmodule.enabled:
+            try:
+                newmodule.matrix_start(self)
+            except Exception:
+                self.logger.exception(f'unhandled exception from {modulename}.matrix_start')
+
+        poll = self.poll_scheduler.remove(modulename)
+        if type(newmodule).matrix_poll is not BotModule.matrix_poll:
+            self.poll_scheduler.add(modulename, newmodule, asyncio.get_event_loop().time(), poll.pollcount if poll else 0)
+        self.poll_wakeup.set()
+        self.update_commands()
+        self.update_sync_filter()
+        return newmodule
+
+    @staticmethod
+    def module_mtimes():
+        mtimes = dict()
+        for modulefile in glob.glob('./modules/*.py'):
+            try:
+                mtimes[os.path.splitext(os.path.basename(modulefile))[0]] = os.stat(modulefile).st_mtime
+            except OSError:
+                pass
+        return mtimes
+
+    async def watch_modules(self):
+        """Reload modules when their files change"""
+        mtimes = self.module_mtimes()
+        while True:
+            await asyncio.sleep(self.module_watch)
+            current = self.module_mtimes()
+            for modulename, mtime in current.items():
+                if modulename in self.modules and mtimes.get(modulename) != mtime:
+                    try:
+                        self.reload_module(modulename)
+                    except Exception:
+                        self.logger.exception(f'Reloading {modulename} failed, keeping the old version running')
+            mtimes = current
 
     def get_modules(self):
         modulefiles = glob.glob('./modules/*.py')
 
         for modulefile in modulefiles:
             modulename = os.path.splitext(os.path.basename(modulefile))[0]
-            moduleobject = self.load_module(modulename)
+            moduleobject = self.new_module(modulename)
             if moduleobject:
                 self.modules[modulename] = moduleobject
+        self.update_commands()
 
     def clear_modules(self):
         self.modules = dict()
 
+    def schedule_polls(self):
+        now = asyncio.get_event_loop().time()
+        self.poll_scheduler.clear()
+        for modulename, moduleobject in self.modules.items():
+            # Don't wake up modules that don't poll at all
+            if type(moduleobject).matrix_poll is not BotModule.matrix_poll:
+                self.poll_scheduler.add(modulename, moduleobject, now)
+        self.poll_wakeup.set()
+
     async def poll_timer(self):
+        loop = asyncio.get_event_loop()
         while True:
-            self.pollcount = self.pollcount + 1
-            for modulename, moduleobject in self.modules.items():
-                if moduleobject.enabled:
-                    try:
-                        await moduleobject.matrix_poll(self, self.pollcount)
-                    except Exception:
-                        self.logger.exception(f'unhandled exception from {modulename}.matrix_poll')
-            await asyncio.sleep(10)
-
-    def set_account_data(self, data):
-        userid = urllib.parse.quote(self.matrix_user)
+            self.poll_wakeup.clear()
+            for poll in self.poll_scheduler.pop_due(loop.time()):
+                if poll.moduleobject.enabled:
+                    self.start_poll(poll.modulename, poll.moduleobject, poll.pollcount)
+            next_due = self.poll_scheduler.next_due()
+            timeout = None if next_due is None else max(next_due - loop.time(), 0)
+            try:
+                await asyncio.wait_for(self.poll_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start_poll(self, modulename, moduleobject, pollcount):
+        stats = self.poll_stats.setdefault(modulename, {'count': 0, 'last': 0.0, 'max': 0.0, 'total': 0.0,
+                                                        'errors': 0, 'timeouts': 0, 'skipped': 0})
+        task = self.poll_tasks.get(modulename)
+        if task and not task.done():
+            stats['skipped'] += 1
+            self.logger.debug(f'{modulename}.matrix_poll still running, skipping poll {pollcount}')
+            return
+        self.poll_tasks[modulename] = asyncio.get_event_loop().create_task(
+            self.poll_module(modulename, moduleobject, pollcount, stats))
 
-        ad_url = f"{self.client.homeserver}/_matrix/client/r0/user/{userid}/account_data/{self.appid}?access_token={self.client.access_token}"
+    async def poll_module(self, modulename, moduleobject, pollcount, stats):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        try:
+            await asyncio.wait_for(moduleobject.matrix_poll(self, pollcount), self.poll_timeout)
+        except asyncio.TimeoutError:
+            stats['timeouts'] += 1
+            self.logger.warning(f'{modulename}.matrix_poll timed out after {self.poll_timeout} seconds')
+        except Exception:
+            stats['errors'] += 1
+            self.logger.exception(f'unhandled exception from {modulename}.matrix_poll')
+        finally:
+            latency = loop.time() - start
+            self.metrics.observe('hemppa_poll_duration_seconds', latency, {'module': modulename})
+            stats['count'] += 1
+            stats['last'] = latency
+            stats['max'] = max(stats['max'], latency)
+            stats['total'] += latency
+
+    def stop_polls(self):
+        if self.poll_task:
+            self.poll_task.cancel()
+        for task in self.poll_tasks.values():
+            task.cancel()
+        self.poll_tasks = dict()
 
-        response = requests.put(ad_url, json.dumps(data))
-        self.__handle_error_response(response)
+    async def account_data_request(self, method, key, data=None):
+        userid = urllib.parse.quote(self.matrix_user)
+        path = f"/_matrix/client/r0/user/{userid}/account_data/{urllib.parse.quote(key)}"
+        headers = {'Authorization': f'Bearer {self.client.access_token}', 'Content-Type': 'application/json'}
+        return await self.client.send(method, path, data, headers)
 
-        if response.status_code != 200:
-            self.logger.error('Setting account data failed. response: %s json: %s', response, response.json())
+    async def set_account_data(self, data, key=None):
+        """Write data to bot's account data. Returns true on success.
 
-    def get_account_data(self):
-        userid = urllib.parse.quote(self.matrix_user)
+        :param data: a dict object that can be converted to JSON
+        :param key: account data event type, defaults to bot's appid
+        """
+        return await self.put_account_data(json.dumps(data), key)
 
-        ad_url = f"{self.client.homeserver}/_matrix/client/r0/user/{userid}/account_data/{self.appid}?access_token={self.client.access_token}"
+    async def put_account_data(self, body, key=None):
+        key = key or self.appid
+        try:
+            response = await self.account_data_request('PUT', key, body)
+            self.__handle_error_response(response)
+            if response.status != 200:
+                self.logger.error('Setting account data %s failed. response: %s json: %s', key, response.status, await response.text())
+                return False
+            response.release()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.logger.error('Setting account data %s failed: %s', key, repr(e))
+            return False
+        return True
 
-        response = requests.get(ad_url)
-        self.__handle_error_response(response)
+    async def get_account_data(self, key=None):
+        """Read bot's account data, or None if it doesn't exist
 
-        if response.status_code == 200:
-            return response.json()
-        self.logger.error(f'Getting account data failed: {response} {response.json()} - this is normal if you have not saved any settings yet.')
+        :param key: account data event type, defaults to bot's appid
+        """
+        key = key or self.appid
+        try:
+            response = await self.account_data_request('GET', key)
+            self.__handle_error_response(response)
+            if response.status == 200:
+                return await response.json()
+            if response.status == 404:
+                response.release()
+                self.logger.debug(f'No account data {key} - this is normal if you have not saved any settings yet.')
+                return None
+            self.logger.error(f'Getting account data {key} failed: {response.status} {await response.text()}')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.logger.error('Getting account data %s failed: %s', key, repr(e))
         return None
 
     def __handle_error_response(self, response):
-        if response.status_code == 401:
+        if response.status == 401:
             self.logger.error("access token is invalid or missing")
             self.logger.info("NOTE: check MATRIX_ACCESS_TOKEN")
             sys.exit(2)
@@ -564,20 +1161,43 @@ class Bot:
         leave_empty_rooms = os.getenv('LEAVE_EMPTY_ROOMS')
 
         if matrix_server and self.matrix_user and bot_owners and access_token:
+            # nio retries rate limited requests by itself, calling response callbacks first, so the send
+            # queue pauses all sending while nio waits.
             self.client = AsyncClient(matrix_server, self.matrix_user, ssl = matrix_server.startswith("https://"))
             self.client.access_token = access_token
+            self.direct_rooms = DirectRooms(self.matrix_user)
+            self.state_store = StateStore(os.getenv('STATE_STORE_PATH', 'config/state.db'))
             self.join_on_invite = (join_on_invite or '').lower() == 'true'
             self.leave_empty_rooms = (leave_empty_rooms or 'true').lower() == 'true'
             self.owners = bot_owners.split(',')
             self.owners_only = owners_only
+            self.media_cache = MediaCache(os.getenv('MEDIA_CACHE_PATH', 'config/mediacache.db'),
+                                          max_entries=int(os.getenv('MEDIA_CACHE_MAX_ENTRIES', 1000)),
+                                          max_bytes=int(os.getenv('MEDIA_CACHE_MAX_BYTES', 0)),
+                                          ttl=int(os.getenv('MEDIA_CACHE_TTL', 0)))
+            self.http_client = HttpClient(max_connections=int(os.getenv('HTTP_MAX_CONNECTIONS', 100)),
+                                          max_per_host=int(os.getenv('HTTP_MAX_PER_HOST', 10)),
+                                          timeout=float(os.getenv('HTTP_TIMEOUT', 30)),
+                                          user_agent=f'Hemppa/{self.version} (+https://github.com/vranki/hemppa/)',
+                                          cache=HttpCache(os.getenv('HTTP_CACHE_PATH', 'config/httpcache.db'),
+                                                          memory_bytes=int(os.getenv('HTTP_CACHE_MEMORY_BYTES', 8 * 1024 * 1024)),
+                                                          max_bytes=int(os.getenv('HTTP_CACHE_MAX_BYTES', 64 * 1024 * 1024))))
+            HttpClient.shared = self.http_client
+            self.send_queue = SendQueue(self.client,
+                                        rate=float(os.getenv('SEND_RATE', 5)),
+                                        burst=int(os.getenv('SEND_BURST', 20)),
+                                        room_rate=float(os.getenv('SEND_ROOM_RATE', 1)),
+                                        room_burst=int(os.getenv('SEND_ROOM_BURST', 5)),
+                                        max_retries=int(os.getenv('SEND_MAX_RETRIES', 3)))
+            self.client.add_response_callback(self.send_queue.on_rate_limited, ErrorResponse)
             self.get_modules()
 
         else:
             self.logger.error("The environment variables MATRIX_SERVER, MATRIX_USER, MATRIX_ACCESS_TOKEN and BOT_OWNERS are mandatory")
             sys.exit(1)
 
-    def start(self):
-        self.load_settings(self.get_account_data())
+    async def start(self):
+        self.load_settings(await self.read_settings())
         enabled_modules = [module for module_name, module in self.modules.items() if module.enabled]
         self.logger.info(f'Starting {len(enabled_modules)} modules..')
         for modulename, moduleobject in self.modules.items():
@@ -586,6 +1206,8 @@ class Bot:
                     moduleobject.matrix_start(self)
                 except Exception:
                     self.logger.exception(f'unhandled exception from {modulename}.matrix_start')
+        self.schedule_polls()
+        self.update_sync_filter()
         self.logger.info(f'All modules started.')
 
     def stop(self):
@@ -598,46 +1220,105 @@ class Bot:
         self.logger.info(f'All modules stopped.')
 
     async def run(self):
-        sync_response = await self.client.sync()
+        self.client.add_global_account_data_callback(self.direct_cb, UnknownAccountDataEvent)
+        self.client.add_response_callback(self.sync_cb, SyncResponse)
+        self.update_sync_filter()
+        sync_token = self.state_store.get('next_batch')
+        if sync_token:
+            rooms = self.state_store.restore_rooms(self.client)
+            direct = self.state_store.get('m.direct')
+            if direct:
+                self.direct_rooms.load_direct(json.loads(direct))
+            self.logger.info(f'Restored {rooms} rooms, resuming sync from previous run')
+            # Events since last run are synced before adding callbacks, so they are not handled as commands.
+            # If there's no stored state, get full state but only the timeline since last run.
+            sync_response = await self.sync_once(sync_filter=self.sync_filter, since=sync_token, full_state=not rooms)
+            if type(sync_response) == SyncResponse:
+                # client.sync() doesn't call response callbacks, so sync_cb doesn't store this
+                self.state_store.save_sync(sync_response, self.client.rooms)
+            if type(sync_response) == SyncError:
+                self.logger.warning(f'Unable to resume sync, doing full initial sync: {sync_response.message}')
+                self.state_store.clear()
+                self.client.rooms.clear()
+                sync_token = None
+        if not sync_token:
+            sync_response = await self.sync_once(sync_filter=self.sync_filter)
+            if type(sync_response) == SyncResponse:
+                self.state_store.save_sync(sync_response, self.client.rooms)
         if type(sync_response) == SyncError:
             self.logger.error(f"Received Sync Error when trying to do initial sync! Error message is: %s", sync_response.message)
         else:
             for roomid, room in self.client.rooms.items():
-                self.logger.info(f"Bot is on '{room.display_name}'({roomid}) with {len(room.users)} users")
-                if len(room.users) == 1 and self.leave_empty_rooms:
+                # member_count comes from room summary, room.users may be incomplete if members are lazy loaded
+                self.logger.info(f"Bot is on '{room.display_name}'({roomid}) with {room.member_count} users")
+                if room.member_count == 1 and self.leave_empty_rooms:
                     self.logger.info(f'Room {roomid} has no other users - leaving it.')
                     self.logger.info(await self.client.room_leave(roomid))
+                else:
+                    self.direct_rooms.update_room(room)
+            # Initial sync contains m.direct, if there is one
+            self.direct_rooms_loaded = True
 
             if self.client.logged_in:
-                self.start()
+                await self.start()
                 self.poll_task = asyncio.get_event_loop().create_task(self.poll_timer())
-                self.load_settings(self.get_account_data())
-                self.client.add_event_callback(self.message_cb, RoomMessageText)
+                self.metrics.start_monitor()
+                if self.watchdog_threshold > 0:
+                    self.watchdog = Watchdog(self.watchdog_threshold, on_stall=self.on_stall)
+                    self.watchdog.start()
+                if self.metrics_port:
+                    try:
+                        await self.metrics.start(self.metrics_addr, int(self.metrics_port))
+                    except (OSError, ValueError) as e:
+                        self.logger.error(f'Unable to serve metrics on {self.metrics_addr}:{self.metrics_port}: {e}')
+                if self.module_watch > 0:
+                    self.logger.info(f'Reloading modules when their files change')
+                    self.watch_task = asyncio.get_event_loop().create_task(self.watch_modules())
+                self.subscribe(self.message_cb, RoomMessageText, prefix='!', owner='core')
+                self.client.add_event_callback(self.event_router.route, Event)
                 self.client.add_event_callback(self.invite_cb, (InviteEvent,))
                 self.client.add_event_callback(self.memberevent_cb, (RoomMemberEvent,))
 
                 if self.join_on_invite:
                     self.logger.info('Note: Bot will join rooms if invited')
                 self.logger.info('Bot running as %s, owners %s', self.client.user, self.owners)
-                self.bot_task = asyncio.create_task(self.client.sync_forever(timeout=30000))
-                await self.bot_task
+                self.bot_task = asyncio.create_task(self.sync_loop())
+                try:
+                    await self.bot_task
+                except asyncio.CancelledError:
+                    self.logger.info('Sync loop stopped')
             else:
                 self.logger.error('Client was not able to log in, check env variables!')
 
     async def shutdown(self):
+        await self.flush_settings()
         await self.close()
 
     async def close(self):
+        if self.watchdog:
+            self.watchdog.stop()
+        await self.metrics.stop()
+        BlockingRunner.shutdown()
         try:
             await self.client.close()
             self.logger.info("Connection closed")
         except Exception as ex:
             self.logger.error("error while closing client: %s", ex)
+        if self.http_client:
+            await self.http_client.aclose()
+            if self.http_client.cache:
+                self.http_client.cache.close()
+        if self.media_cache:
+            self.media_cache.close()
+        if self.state_store:
+            self.state_store.close()
 
     def handle_exit(self, signame, loop):
         self.logger.info(f"Received signal {signame}")
-        if self.poll_task:
-            self.poll_task.cancel()
+        self.stop_polls()
+        if self.watch_task:
+            self.watch_task.cancel()
+        self.command_queue.cancel()
         self.bot_task.cancel()
         self.stop()
 
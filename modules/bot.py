@@ -1,12 +1,13 @@
+import asyncio
 import collections
 import logging
 import json
-import requests
 from html import escape
 from datetime import timedelta
 import time
 
 from nio import RoomCreateError
+from modules.common.lazymodule import LazyModule
 from modules.common.module import BotModule, ModuleCannotBeDisabled
 
 class LogDequeHandler(logging.Handler):
@@ -16,10 +17,12 @@ class LogDequeHandler(logging.Handler):
         self.level = logging.INFO
 
     def emit(self, record):
+        # Messages about a bot module logged from elsewhere, e.g. by the watchdog, are filed under the module
+        module = str(getattr(record, 'bot_module', record.module))
         try:
-            self.logs[str(record.module)].append(record)
+            self.logs[module].append(record)
         except:
-            self.logs[str(record.module)] = collections.deque([record], maxlen=15)
+            self.logs[module] = collections.deque([record], maxlen=15)
 
 class MatrixModule(BotModule):
 
@@ -59,12 +62,18 @@ class MatrixModule(BotModule):
                 await self.get_ping(bot, room, event)
             elif args[1] == 'rooms':
                 await self.rooms(bot, room, event)
+            elif args[1] == 'polls':
+                await self.polls(bot, room)
+            elif args[1] == 'events':
+                await self.events(bot, room)
 
         elif len(args) == 3:
             if args[1] == 'enable':
                 await self.enable_module(bot, room, event, args[2])
             elif args[1] == 'disable':
                 await self.disable_module(bot, room, event, args[2])
+            elif args[1] == 'reload':
+                await self.reload_module(bot, room, event, args[2])
             elif args[1] == 'export':
                 await self.export_settings(bot, event, module_name=args[2])
             elif args[1] == 'import':
@@ -92,7 +101,7 @@ class MatrixModule(BotModule):
         serv_delta = None
         event_url = f'{bot.client.homeserver}/_matrix/client/r0/rooms/{room.room_id}/event/{pong.event_id}?access_token={bot.client.access_token}'
         try:
-            serv_delta = requests.get(event_url).json()['origin_server_ts'] - serv_before
+            serv_delta = (await self.http.get(event_url)).json()['origin_server_ts'] - serv_before
             delta = f'server response in {local_delta}ms, event created in {serv_delta}ms'
         except Exception as e:
             self.logger.error(f"Failed getting server timestamp: {e}")
@@ -111,7 +120,7 @@ class MatrixModule(BotModule):
             'msgtype': 'm.notice',
             'body': delta
         }
-        await bot.client.room_send(room.room_id, 'm.room.message', content)
+        await bot.send_event(room, 'm.room.message', content)
 
     async def leave(self, bot, room, event):
         bot.must_be_admin(room, event)
@@ -148,16 +157,50 @@ class MatrixModule(BotModule):
         uptime  = str(timedelta(seconds=(systime - self.starttime))).split('.', 1)[0]
         systime = time.ctime(systime)
         enabled = sum(1 for module in bot.modules.values() if module.enabled)
+        lazy = sum(1 for module in bot.modules.values() if isinstance(module, LazyModule))
+
+        commands = bot.command_queue.stats()
+        sending = bot.send_queue.stats()
+        lag = bot.metrics.lag_stats()
 
         return await bot.send_text(room, f'Uptime: {uptime} - System time: {systime} '
-                f'- {enabled} modules enabled out of {len(bot.modules)} loaded.')
+                f'- {enabled} modules enabled out of {len(bot.modules)} loaded, {lazy} not imported yet. '
+                f"Commands: {commands['running']} running, {commands['queued']} queued in {commands['rooms']} rooms, "
+                f"{commands['completed']} completed, {commands['rejected']} rejected, "
+                f"wait avg {commands['avg_wait'] * 1000:.0f} ms, max {commands['max_wait'] * 1000:.0f} ms. "
+                f"Sending: {sending['queued']} queued in {sending['rooms']} rooms, {sending['sent']} sent, "
+                f"{sending['failed']} failed, {sending['retries']} retries, rate limited {sending['rate_limited']} times, "
+                f"throttled {sending['throttle_wait']:.1f} s, max wait {sending['max_wait'] * 1000:.0f} ms. "
+                f"Event loop lag {lag['last'] * 1000:.0f} ms, max {lag['max'] * 1000:.0f} ms, "
+                f"blocked {lag['blocked']:.1f} s in total.")
+
+    async def polls(self, bot, room):
+        now = asyncio.get_event_loop().time()
+        text = f'Poll timeout {bot.poll_timeout} seconds:'
+        for modulename, interval, next_poll in bot.poll_scheduler.schedule(now):
+            stats = bot.poll_stats.get(modulename)
+            schedule = f"'{interval}'" if isinstance(interval, str) else f'every {interval} s'
+            text += f'\n - {modulename}: {schedule}, next in {max(next_poll, 0):.0f} s'
+            if stats and stats['count']:
+                average = stats['total'] / stats['count']
+                text += (f"; last {stats['last'] * 1000:.0f} ms, avg {average * 1000:.0f} ms, "
+                         f"max {stats['max'] * 1000:.0f} ms, {stats['count']} polls, {stats['errors']} errors, "
+                         f"{stats['timeouts']} timeouts, {stats['skipped']} skipped")
+        return await bot.send_text(room, text)
+
+    async def events(self, bot, room):
+        text = 'Event subscriptions:'
+        for module, name, count, errors, average, maximum in bot.event_router.stats():
+            text += (f'\n - {module}.{name}: {count} events, {errors} errors, '
+                     f'avg {average * 1000:.0f} ms, max {maximum * 1000:.0f} ms')
+        return await bot.send_text(room, text)
 
     async def reload(self, bot, room, event):
         bot.must_be_owner(event)
         msg = await bot.send_text(room, f'Reloading modules...')
         bot.stop()
-        bot.reload_modules()
-        bot.start()
+        await bot.reload_modules()
+        await bot.start()
         # update event
         content = {
             'm.new_content': {
@@ -171,7 +214,7 @@ class MatrixModule(BotModule):
             'msgtype': 'm.notice',
             'body': 'Modules reloaded!'
         }
-        await bot.client.room_send(room.room_id, 'm.room.message', content)
+        await bot.send_event(room, 'm.room.message', content)
 
     async def version(self, bot, room):
         await bot.send_text(room, f'Hemppa version {bot.version} - https://github.com/vranki/hemppa')
@@ -182,6 +225,17 @@ class MatrixModule(BotModule):
         self.logger.info(f'{event.sender} commanded bot to quit, so quitting..')
         bot.bot_task.cancel()
 
+    async def reload_module(self, bot, room, event, module_name):
+        bot.must_be_owner(event)
+        self.logger.info(f"Asked to reload {module_name}")
+        if bot.modules.get(module_name):
+            try:
+                bot.reload_module(module_name)
+            except Exception as e:
+                return await bot.send_text(room, f"Module {module_name} was not reloaded: {repr(e)}")
+            return await bot.send_text(room, f"Module {module_name} reloaded")
+        return await bot.send_text(room, f"Module with name {module_name} not found. Execute !bot modules for a list of available modules")
+
     async def enable_module(self, bot, room, event, module_name):
         bot.must_be_owner(event)
         self.logger.info(f"Asked to enable {module_name}")
@@ -189,6 +243,7 @@ class MatrixModule(BotModule):
             module = bot.modules.get(module_name)
             module.enable()
             module.matrix_start(bot)
+            bot.update_sync_filter()
             bot.save_settings()
             return await bot.send_text(room, f"Module {module_name} enabled")
         return await bot.send_text(room, f"Module with name {module_name} not found. Execute !bot modules for a list of available modules")
@@ -205,6 +260,7 @@ class MatrixModule(BotModule):
             except Exception as e:
                 return await bot.send_text(room, f"Module {module_name} was not disabled: {repr(e)}")
             module.matrix_stop(bot)
+            bot.update_sync_filter()
             bot.save_settings()
             return await bot.send_text(room, f"Module {module_name} disabled")
         return await bot.send_text(room, f"Module with name {module_name} not found. Execute !bot modules for a list of available modules")
@@ -218,7 +274,7 @@ class MatrixModule(BotModule):
 
     async def export_settings(self, bot, event, module_name=None):
         bot.must_be_owner(event)
-        data = bot.get_account_data()['module_settings']
+        data = (await bot.read_settings())['module_settings']
         if module_name:
             data = data[module_name]
             self.logger.info(f"{event.sender} is exporting settings for module {module_name}")
@@ -231,7 +287,7 @@ class MatrixModule(BotModule):
 
         self.logger.info(f"{event.sender} is importing settings")
         try:
-            account_data = bot.get_account_data()
+            account_data = await bot.read_settings()
             child = account_data['module_settings']
         except KeyError: # no data yet
             account_data['module_settings'] = dict()
@@ -290,14 +346,16 @@ class MatrixModule(BotModule):
         bot.must_be_owner(event)
         if action == 'view':
             self.logger.info(f"{event.sender} wants to see the uri cache")
-            msg = [f'uri cache size: {len(bot.uri_cache)}']
-            for key, val in bot.uri_cache.items():
-                msg.append('- ' + key + ': ' + val[0])
+            stats = bot.media_cache.stats()
+            msg = [f'uri cache size: {stats["entries"]} entries, {stats["bytes"]} bytes - '
+                   f'hits: {stats["hits"]}, misses: {stats["misses"]}, '
+                   f'evictions: {stats["evictions"]}, expirations: {stats["expirations"]}']
+            for key, matrix_uri in bot.media_cache.items(limit=50):
+                msg.append('- ' + key + ': ' + matrix_uri)
             return await bot.send_text(room, '\n'.join(msg))
         if action in ['clean', 'clear']:
             self.logger.info(f"{event.sender} wants to clear the uri cache")
-            bot.uri_cache = dict()
-            bot.save_settings()
+            bot.media_cache.clear()
 
     async def rooms(self, bot, room, event):
         bot.must_be_owner(event)
@@ -311,17 +369,20 @@ class MatrixModule(BotModule):
         raise ModuleCannotBeDisabled
 
     def help(self):
-        return 'Bot management commands. (quit, version, reload, status, stats, leave, modules, enable, disable, import, export, ping)'
+        return 'Bot management commands. (quit, version, reload, status, stats, leave, modules, polls, events, enable, disable, import, export, ping)'
 
     def long_help(self, bot=None, event=None, **kwargs):
         text = self.help() + (
                 '\n- "!bot version": get bot version'
                 '\n- "!bot ping": get the ping time to the server'
                 '\n- "!bot status": get bot uptime and status'
-                '\n- "!bot stats": get current users, rooms, and homeservers')
+                '\n- "!bot stats": get current users, rooms, and homeservers'
+                '\n- "!bot polls": get module polling latency and statistics'
+                '\n- "!bot events": get event subscriptions and their latency')
         if bot and event and bot.is_owner(event):
             text += ('\n- "!bot quit": kill the bot :('
                      '\n- "!bot reload": reload the bot modules'
+                     '\n- "!bot reload [module]": reload one module, keeping the others running'
                      '\n- "!bot uricache (view|clean)": view or clean the bot\'s URI cache'
                      '\n- "!bot logs [module] ([count])": get [count] most recent logs from [module]'
                      '\n- "!bot enable [module]": enable a module'
@@ -0,0 +1,117 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import os
+
+
+class BlockingCancelled(Exception):
+    """Raised by BotModule.run_blocking() when the module is stopped while waiting"""
+    pass
+
+
+class BlockingRunner:
+    """Runs blocking functions of one module in a thread or process pool
+
+    The pools are shared by all modules. Each module can have at most limit functions
+    running or waiting for a worker at a time, so one module can't take all the workers.
+    Use through BotModule.run_blocking().
+
+    Threads can't be interrupted: on timeout or cancel() the caller stops waiting, but a
+    function that has already started runs to the end in the background and its result is
+    discarded. It keeps its place in the limit until it ends, so functions that hang can
+    only take limit workers. Functions that haven't started yet are not run at all. After
+    cancel(), callers get BlockingCancelled.
+    """
+
+    thread_pool = None
+    process_pool = None
+
+    def __init__(self, name, limit=2, timeout=60):
+        self.logger = logging.getLogger("module " + name)
+        self.name = name
+        self.limit = limit
+        self.timeout = timeout
+        self.semaphore = None
+        self.stopped = None  # Future that is done when cancel() is called
+
+    @classmethod
+    def executor(cls, process=False):
+        if process:
+            if cls.process_pool is None:
+                cls.process_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=int(os.getenv('BLOCKING_PROCESSES', 2)) or None)
+            return cls.process_pool
+        if cls.thread_pool is None:
+            cls.thread_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=int(os.getenv('BLOCKING_THREADS', 16)) or None, thread_name_prefix='hemppa-blocking')
+        return cls.thread_pool
+
+    @classmethod
+    def shutdown(cls):
+        for pool in (cls.thread_pool, cls.process_pool):
+            if pool:
+                pool.shutdown(wait=False)
+        cls.thread_pool = cls.process_pool = None
+
+    async def run(self, func, *args, timeout=None, process=False, **kwargs):
+        loop = asyncio.get_event_loop()
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.limit)
+        if self.stopped is None:
+            self.stopped = loop.create_future()
+        stopped = self.stopped
+        timeout = timeout or self.timeout
+        semaphore = self.semaphore
+        await self.acquire(semaphore, stopped)
+        try:
+            if stopped.done():
+                raise BlockingCancelled(f'{self.name} was stopped')
+            work = self.executor(process).submit(functools.partial(func, *args, **kwargs))
+        except BaseException:
+            semaphore.release()
+            raise
+        # Released when the function has really ended (or was cancelled before it started),
+        # not when the caller stops waiting
+        work.add_done_callback(lambda _: self.release(loop, semaphore))
+        future = asyncio.wrap_future(work)
+        try:
+            done, _ = await asyncio.wait({future, stopped}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        if future in done:
+            return future.result()
+        future.cancel()
+        if stopped.done():
+            raise BlockingCancelled(f'{self.name} was stopped')
+        self.logger.warning(f'{getattr(func, "__name__", func)} did not finish in {timeout} seconds')
+        raise asyncio.TimeoutError()
+
+    async def acquire(self, semaphore, stopped):
+        """Wait for a place in the limit, or BlockingCancelled if stopped first"""
+        acquire = asyncio.ensure_future(semaphore.acquire())
+        try:
+            await asyncio.wait({acquire, stopped}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            acquire.cancel()
+            if acquire.done() and not acquire.cancelled():
+                semaphore.release()
+            raise
+        if not acquire.done():
+            acquire.cancel()
+            raise BlockingCancelled(f'{self.name} was stopped')
+
+    @staticmethod
+    def release(loop, semaphore):
+        # Called in the worker thread
+        try:
+            loop.call_soon_threadsafe(semaphore.release)
+        except RuntimeError:
+            pass  # Loop closed
+
+    def cancel(self):
+        """Stop waiting for all functions of this module"""
+        if self.stopped and not self.stopped.done():
+            self.stopped.set_result(None)
+        self.stopped = None
@@ -0,0 +1,109 @@
+import asyncio
+import collections
+import logging
+
+
+class CommandQueue:
+    """Runs bot commands in background, so that a slow command doesn't hold up the sync loop
+
+    Each room has its own queue, which is processed in order by a worker task. At most
+    max_running commands run at the same time. A room can have at most max_room_queue
+    commands waiting or running, and a user at most max_user_queue in all rooms.
+    Zero means no limit.
+    """
+
+    def __init__(self, max_running=8, max_room_queue=20, max_user_queue=5):
+        self.logger = logging.getLogger("hemppa.commandqueue")
+        self.max_room_queue = max_room_queue
+        self.max_user_queue = max_user_queue
+        self.semaphore = asyncio.Semaphore(max_running) if max_running else None
+        self.queues = dict()  # Room id -> deque of (queued time, user id, job)
+        self.workers = dict()  # Room id -> worker task
+        self.user_pending = collections.Counter()  # User id -> commands waiting or running
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, room_id, user_id, job):
+        """Queue job (a coroutine function without arguments) to run in room's order.
+
+        :return: False if the room or user has too many commands queued already
+        """
+        queue = self.queues.setdefault(room_id, collections.deque())
+        # Running command is not in the queue anymore, but counts towards the limit
+        room_pending = len(queue) + (1 if room_id in self.workers and self.workers[room_id].running else 0)
+        if self.max_room_queue and room_pending >= self.max_room_queue:
+            self.rejected += 1
+            self.logger.warning(f'Too many commands queued in {room_id}, dropping command from {user_id}')
+            return False
+        if self.max_user_queue and self.user_pending[user_id] >= self.max_user_queue:
+            self.rejected += 1
+            self.logger.warning(f'Too many commands queued by {user_id}, dropping command')
+            return False
+
+        queue.append((asyncio.get_event_loop().time(), user_id, job))
+        self.user_pending[user_id] += 1
+        if room_id not in self.workers:
+            self.workers[room_id] = RoomWorker(self, room_id)
+        return True
+
+    async def run(self, room_id, worker):
+        loop = asyncio.get_event_loop()
+        queue = self.queues[room_id]
+        try:
+            while queue:
+                queued, user_id, job = queue.popleft()
+                worker.running = True
+                try:
+                    if self.semaphore:
+                        await self.semaphore.acquire()
+                    try:
+                        wait = loop.time() - queued
+                        self.total_wait += wait
+                        self.max_wait = max(self.max_wait, wait)
+                        self.running += 1
+                        await job()
+                    finally:
+                        self.running -= 1
+                        if self.semaphore:
+                            self.semaphore.release()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.logger.exception(f'unhandled exception running command in {room_id}')
+                finally:
+                    worker.running = False
+                    self.completed += 1
+                    self.user_pending[user_id] -= 1
+                    if self.user_pending[user_id] <= 0:
+                        del self.user_pending[user_id]
+        finally:
+            self.workers.pop(room_id, None)
+            if not queue:
+                self.queues.pop(room_id, None)
+
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'queued': self.queued(),
+            'rooms': len(self.workers),
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'avg_wait': self.total_wait / self.completed if self.completed else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+    def cancel(self):
+        for worker in list(self.workers.values()):
+            worker.task.cancel()
+
+
+class RoomWorker:
+    def __init__(self, commandqueue, room_id):
+        self.running = False
+        self.task = asyncio.get_event_loop().create_task(commandqueue.run(room_id, self))
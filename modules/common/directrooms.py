@@ -0,0 +1,75 @@
+class DirectRooms:
+    """Index of direct message rooms by user id
+
+    Built from the m.direct account data event and from room membership. Rooms where the
+    bot and one other user are members count as direct message rooms with that user, as
+    they always have. Members may be lazy loaded, so room.users can be only the members
+    seen so far: the member count from the room summary decides whether a room has two
+    members. Update with load_direct() when m.direct changes and update_room() on
+    membership changes.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.direct = dict()  # User id -> [room id, ..] from m.direct
+        self.member_rooms = dict()  # User id -> [room id, ..], from membership
+        self.room_members = dict()  # Room id -> user id, reverse of member_rooms
+        self.created = dict()  # Room id -> RoomCreateResponse, for rooms created but not synced yet
+
+    def load_direct(self, content):
+        self.direct = {user_id: list(room_ids) for user_id, room_ids in content.items() if isinstance(room_ids, list)}
+
+    def add_direct(self, user_id, room_id, response=None):
+        rooms = self.direct.setdefault(user_id, [])
+        if room_id not in rooms:
+            rooms.append(room_id)
+        if response:
+            self.created[room_id] = response
+
+    def update_room(self, room):
+        """Update index with current members of a MatrixRoom"""
+        self.created.pop(room.room_id, None)
+        previous = self.room_members.pop(room.room_id, None)
+        if previous:
+            rooms = self.member_rooms.get(previous, [])
+            if room.room_id in rooms:
+                rooms.remove(room.room_id)
+            if not rooms:
+                self.member_rooms.pop(previous, None)
+
+        if not self.is_direct(room):
+            return
+        others = [user_id for user_id in self.members(room) if user_id != self.user_id]
+        if len(others) == 1:
+            self.room_members[room.room_id] = others[0]
+            self.member_rooms.setdefault(others[0], []).append(room.room_id)
+
+    @staticmethod
+    def members(room):
+        """Known members of room: loaded members and the heroes of the room summary"""
+        members = set(room.users)
+        if room.summary and room.summary.heroes:
+            members.update(room.summary.heroes)
+        return members
+
+    def is_direct(self, room, user_id=None):
+        """True if room has exactly two members, the bot and user_id (or anyone)"""
+        if room.member_count != 2:
+            return False
+        members = self.members(room)
+        return self.user_id in members and (user_id is None or user_id in members)
+
+    def get(self, user_id, rooms):
+        """Return direct message room with user, or None if there isn't one
+
+        :param rooms: the client's rooms (room id -> MatrixRoom), used to check the room is still valid
+        """
+        candidates = list(reversed(self.direct.get(user_id, [])))  # Newest first
+        candidates.extend(self.member_rooms.get(user_id, []))
+        for room_id in candidates:
+            room = rooms.get(room_id)
+            if room and self.is_direct(room, user_id):
+                return room
+            if not room and room_id in self.created:
+                return self.created[room_id]
+        return None
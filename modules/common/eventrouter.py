@@ -0,0 +1,173 @@
+import asyncio
+import itertools
+import logging
+import re
+
+
+class Subscription:
+    """A callback subscribed to room events with EventRouter.subscribe()"""
+
+    def __init__(self, seq, callback, event_types, rooms, prefix, regex, owner):
+        self.seq = seq
+        self.callback = callback
+        self.event_types = event_types
+        self.rooms = rooms
+        self.prefix = prefix
+        self.regex = re.compile(regex) if isinstance(regex, str) else regex
+        self.owner = owner
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @property
+    def module(self):
+        return self.owner or getattr(self.callback, '__module__', None) or 'core'
+
+    @property
+    def name(self):
+        return getattr(self.callback, '__qualname__', None) or repr(self.callback)
+
+    def matches(self, event):
+        if self.prefix is None and self.regex is None:
+            return True
+        body = getattr(event, 'body', None)
+        if not isinstance(body, str):
+            return False
+        if self.prefix is not None and not body.startswith(self.prefix):
+            return False
+        if self.regex is not None and not self.regex.search(body):
+            return False
+        return True
+
+
+class EventIndex:
+    """Subscriptions to one event type: for all rooms, and by room id"""
+
+    def __init__(self):
+        self.all_rooms = []
+        self.rooms = dict()  # Room id -> [Subscription, ..]
+
+    def add(self, subscription):
+        if subscription.rooms is None:
+            self.all_rooms.append(subscription)
+        else:
+            for room_id in subscription.rooms:
+                self.rooms.setdefault(room_id, []).append(subscription)
+
+    def get(self, room_id):
+        room_subscriptions = self.rooms.get(room_id)
+        if not room_subscriptions:
+            return self.all_rooms
+        if not self.all_rooms:
+            return room_subscriptions
+        return sorted(self.all_rooms + room_subscriptions, key=lambda subscription: subscription.seq)
+
+
+class EventRouter:
+    """Routes room events to subscribed callbacks
+
+    Subscriptions are indexed by event class (nio event classes, matching subclasses too) or
+    event type string (e.g. 'im.vector.modular.widgets'), and by room id, so an event is only
+    passed to the callbacks that want it. Callbacks are called in order of subscription, and
+    exceptions from them are logged. Time spent in each callback is recorded.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("hemppa.eventrouter")
+        self.subscriptions = []
+        self.counter = itertools.count()
+        self.type_names = dict()  # Event type string -> EventIndex
+        self.classes = dict()  # Event class -> [Subscription, ..]
+        self.class_cache = dict()  # Event class -> EventIndex of subscriptions to it and its base classes
+
+    def subscribe(self, callback, event_types, rooms=None, prefix=None, regex=None, owner=None):
+        """Subscribe callback(room, event) to events
+
+        :param event_types: event class, event type string, or a list of them
+        :param rooms: iterable of room ids to receive events from, None for all rooms
+        :param prefix: only receive events with body starting with this
+        :param regex: only receive events with body matching this regular expression
+        :param owner: name of the module subscribing, for statistics
+        :return: a Subscription, which can be passed to unsubscribe() and set_rooms()
+        """
+        if not isinstance(event_types, (list, tuple, set)):
+            event_types = [event_types]
+        subscription = Subscription(next(self.counter), callback, list(event_types),
+                                    None if rooms is None else set(rooms), prefix, regex, owner)
+        self.subscriptions.append(subscription)
+        self.rebuild()
+        return subscription
+
+    def unsubscribe(self, subscription_or_callback):
+        """Remove a subscription, or all subscriptions of a callback"""
+        self.subscriptions = [subscription for subscription in self.subscriptions
+                              if subscription is not subscription_or_callback
+                              and subscription.callback != subscription_or_callback]
+        self.rebuild()
+
+    def unsubscribe_owner(self, owner):
+        """Remove all subscriptions of a module"""
+        self.subscriptions = [subscription for subscription in self.subscriptions if subscription.owner != owner]
+        self.rebuild()
+
+    def set_rooms(self, subscription, rooms):
+        """Change the rooms subscription receives events from, None for all rooms"""
+        subscription.rooms = None if rooms is None else set(rooms)
+        self.rebuild()
+
+    def rebuild(self):
+        self.type_names = dict()
+        self.classes = dict()
+        self.class_cache = dict()
+        for subscription in self.subscriptions:
+            for event_type in subscription.event_types:
+                if isinstance(event_type, str):
+                    self.type_names.setdefault(event_type, EventIndex()).add(subscription)
+                else:
+                    self.classes.setdefault(event_type, []).append(subscription)
+
+    def class_index(self, event_class):
+        index = self.class_cache.get(event_class)
+        if index is None:
+            subscriptions = set()
+            for base in event_class.__mro__:
+                subscriptions.update(self.classes.get(base, []))
+            index = EventIndex()
+            for subscription in sorted(subscriptions, key=lambda subscription: subscription.seq):
+                index.add(subscription)
+            self.class_cache[event_class] = index
+        return index
+
+    def subscribers(self, room, event):
+        subscriptions = self.class_index(type(event)).get(room.room_id)
+        source = getattr(event, 'source', None)
+        if self.type_names and isinstance(source, dict):
+            index = self.type_names.get(source.get('type'))
+            if index:
+                subscriptions = sorted(set(subscriptions + index.get(room.room_id)), key=lambda subscription: subscription.seq)
+        return subscriptions
+
+    async def route(self, room, event):
+        """Pass event to subscribers. Use as nio event callback."""
+        loop = asyncio.get_event_loop()
+        for subscription in self.subscribers(room, event):
+            if not subscription.matches(event):
+                continue
+            start = loop.time()
+            try:
+                await subscription.callback(room, event)
+            except Exception:
+                subscription.errors += 1
+                self.logger.exception(f'unhandled exception from {subscription.module}.{subscription.name}')
+            finally:
+                elapsed = loop.time() - start
+                subscription.count += 1
+                subscription.total += elapsed
+                subscription.max = max(subscription.max, elapsed)
+
+    def stats(self):
+        """Return (module, name, events, errors, average seconds, max seconds) for each subscription"""
+        return [(subscription.module, subscription.name, subscription.count, subscription.errors,
+                 subscription.total / subscription.count if subscription.count else 0.0, subscription.max)
+                for subscription in self.subscriptions]
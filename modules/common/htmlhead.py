@@ -0,0 +1,159 @@
+import codecs
+import re
+from html.parser import HTMLParser
+
+# Bytes to look for a <meta charset> in, before decoding (like browsers do)
+PRESCAN_BYTES = 1024
+META_CHARSET = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([a-zA-Z0-9_:.-]+)', re.IGNORECASE)
+HEADER_CHARSET = re.compile(r'charset\s*=\s*["\']?\s*([a-zA-Z0-9_:.-]+)', re.IGNORECASE)
+BOMS = ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'))
+
+# Meta tags collected: (attribute, lowercase value) -> name in HeadParser.meta
+META_TAGS = {
+    ('name', 'title'): 'title',
+    ('property', 'og:title'): 'og:title',
+    ('name', 'description'): 'description',
+}
+
+
+class HeadParser(HTMLParser):
+    """Collects the title and meta tags of an HTML document, up to the end of <head>
+
+    done is True when the head has ended, or the title and all META_TAGS have been seen,
+    so the rest of the document doesn't need to be fed.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = None
+        self.meta = dict()  # Name in META_TAGS -> content
+        self.in_title = False
+        self.title_parts = []
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'title' and self.title is None:
+            self.in_title = True
+        elif tag == 'meta':
+            attrs = dict(attrs)
+            content = attrs.get('content')
+            if content is None:
+                return
+            for attribute in ('name', 'property'):
+                name = META_TAGS.get((attribute, (attrs.get(attribute) or '').lower()))
+                if name and name not in self.meta:
+                    self.meta[name] = content
+            self.check_done()
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self.in_title:
+            self.in_title = False
+            self.title = ''.join(self.title_parts)
+            self.check_done()
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title_parts.append(data)
+
+    def check_done(self):
+        if self.title is not None and len(self.meta) == len(META_TAGS):
+            self.done = True
+
+
+class HeadExtractor:
+    """Extracts title and description from an HTML document fed in chunks of bytes
+
+    Decodes with the charset from the Content-Type header, a byte order mark, or a
+    <meta charset> in the first PRESCAN_BYTES bytes, in that order, falling back to UTF-8.
+    feed() returns True when the head has been read, so reading can stop there.
+
+    Example:
+
+        extractor = HeadExtractor(response.headers.get('content-type'))
+        async for chunk in response.aiter_bytes():
+            if extractor.feed(chunk):
+                break
+        title, description = extractor.close()
+    """
+
+    def __init__(self, content_type=None):
+        self.parser = HeadParser()
+        self.encoding = self.header_charset(content_type)
+        self.decoder = None
+        self.pending = b''  # Bytes held until the encoding is known
+
+    @staticmethod
+    def header_charset(content_type):
+        match = HEADER_CHARSET.search(content_type or '')
+        return match.group(1) if match and HeadExtractor.known_encoding(match.group(1)) else None
+
+    @staticmethod
+    def known_encoding(name):
+        try:
+            codecs.lookup(name)
+            return True
+        except LookupError:
+            return False
+
+    def sniff_encoding(self, data):
+        for bom, encoding in BOMS:
+            if data.startswith(bom):
+                return encoding
+        match = META_CHARSET.search(data[:PRESCAN_BYTES])
+        if match:
+            encoding = match.group(1).decode('ascii')
+            if self.known_encoding(encoding):
+                return encoding
+        return 'utf-8'
+
+    def start_decoding(self, data):
+        if self.encoding is None:
+            self.encoding = self.sniff_encoding(data)
+        self.decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+
+    @property
+    def done(self):
+        return self.parser.done
+
+    def feed(self, data):
+        """Feed the next chunk of the document. Returns True when the rest isn't needed."""
+        if self.done:
+            return True
+        if self.decoder is None:
+            self.pending += data
+            if self.encoding is None and len(self.pending) < PRESCAN_BYTES:
+                return False
+            data, self.pending = self.pending, b''
+            self.start_decoding(data)
+        self.parser.feed(self.decoder.decode(data))
+        return self.done
+
+    def close(self):
+        """Finish parsing. Returns (title, description), None for those not found."""
+        if self.decoder is None:
+            self.start_decoding(self.pending)
+            self.parser.feed(self.decoder.decode(self.pending))
+        if not self.done:
+            self.parser.feed(self.decoder.decode(b'', final=True))
+            self.parser.close()
+        return self.title, self.description
+
+    @property
+    def title(self):
+        parser = self.parser
+        if parser.title is None and parser.in_title:
+            # Document ended inside <title>
+            parser.title = ''.join(parser.title_parts)
+        if parser.title and parser.title.strip():
+            return parser.title
+        return parser.meta.get('title') or parser.meta.get('og:title')
+
+    @property
+    def description(self):
+        return self.parser.meta.get('description')
@@ -0,0 +1,270 @@
+import collections
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+import urllib.parse
+
+# Responses without Cache-Control or Expires but with Last-Modified are considered fresh for
+# this fraction of their age (RFC 7234 heuristic freshness), up to MAX_HEURISTIC_TTL seconds
+HEURISTIC_FRACTION = 0.1
+MAX_HEURISTIC_TTL = 24 * 60 * 60
+# Response headers stored with the content. Content is stored decoded, so not Content-Encoding.
+STORED_HEADERS = {'content-type', 'content-language', 'cache-control', 'date', 'expires',
+                  'etag', 'last-modified', 'location'}
+# Query parameters that may hold credentials, left out of urls stored on disk
+SECRET_PARAMS = re.compile(r'(key|token|secret|password|passwd|auth|sig|signature|session)', re.IGNORECASE)
+
+
+class CachedResponse:
+    def __init__(self, url, status_code, headers, content, stored, expires):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers  # Dict of lowercase header name -> value
+        self.content = content
+        self.stored = stored  # Time the response was received or revalidated
+        self.expires = expires  # Time after which the response must be revalidated
+
+    @property
+    def size(self):
+        return len(self.content) + len(self.url)
+
+    def fresh(self, now=None):
+        return (now or time.time()) < self.expires
+
+    def validators(self):
+        """Headers for a conditional request that returns 304 if the response hasn't changed"""
+        headers = dict()
+        if 'etag' in self.headers:
+            headers['If-None-Match'] = self.headers['etag']
+        if 'last-modified' in self.headers:
+            headers['If-Modified-Since'] = self.headers['last-modified']
+        return headers
+
+
+class HttpCache:
+    """Cache of HTTP GET responses, used by HttpClient for requests made with cache=...
+
+    Follows Cache-Control (no-store, no-cache, max-age), Expires and Last-Modified to decide
+    how long a response is fresh. Fresh responses are returned without contacting the server.
+    Stale responses with an ETag or Last-Modified are revalidated with a conditional request,
+    so unchanged resources are not downloaded again. A ttl given by the module overrides the
+    freshness given by the server.
+
+    Responses are kept in memory, up to memory_bytes, and in a SQLite database at path
+    (if set), up to max_bytes. Least recently used responses are evicted first. Urls may
+    contain credentials (e.g. api_key=...), so the database has a hash of the url as the
+    key, and the url without parameters that look like credentials.
+    """
+
+    def __init__(self, path=None, memory_bytes=8 * 1024 * 1024, max_bytes=64 * 1024 * 1024, max_entry_bytes=1024 * 1024):
+        self.logger = logging.getLogger("hemppa.httpcache")
+        self.memory = collections.OrderedDict()  # Key -> CachedResponse, least recently used first
+        self.memory_bytes = memory_bytes
+        self.memory_used = 0
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self.disk_entries = 0
+        self.disk_bytes = 0
+        self.db = None
+
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.db = sqlite3.connect(path, isolation_level=None)
+            self.db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, status INTEGER, '
+                            'headers TEXT, content BLOB, size INTEGER, stored REAL, expires REAL, last_used REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+            # Drop responses stored by versions that used plain urls as keys
+            self.db.execute("DELETE FROM responses WHERE length(key) != 64 OR key GLOB '*[^0-9a-f]*'")
+            self.disk_entries, self.disk_bytes = self.db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+
+    @staticmethod
+    def db_key(key):
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    @staticmethod
+    def redact_url(url):
+        parts = urllib.parse.urlsplit(url)
+        if not parts.query:
+            return url
+        query = [(name, '' if SECRET_PARAMS.search(name) else value)
+                 for name, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)]
+        return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+    @staticmethod
+    def parse_cache_control(headers):
+        directives = dict()
+        for directive in headers.get('cache-control', '').split(','):
+            name, _, value = directive.strip().partition('=')
+            if name:
+                directives[name.lower()] = value.strip('"')
+        return directives
+
+    @staticmethod
+    def parse_date(value):
+        try:
+            return email.utils.parsedate_to_datetime(value).timestamp() if value else None
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return None
+
+    @classmethod
+    def freshness(cls, headers, now):
+        """Seconds a response with headers is fresh, or None if it must not be stored"""
+        cache_control = cls.parse_cache_control(headers)
+        if 'no-store' in cache_control or 'private' in cache_control:
+            return None
+        if 'no-cache' in cache_control:
+            return 0
+        for directive in ('s-maxage', 'max-age'):
+            if directive in cache_control:
+                try:
+                    return max(int(cache_control[directive]), 0)
+                except ValueError:
+                    return 0
+        date = cls.parse_date(headers.get('date')) or now
+        if 'expires' in headers:
+            expires = cls.parse_date(headers['expires'])
+            return max(expires - date, 0) if expires else 0
+        last_modified = cls.parse_date(headers.get('last-modified'))
+        if last_modified:
+            return min(max(date - last_modified, 0) * HEURISTIC_FRACTION, MAX_HEURISTIC_TTL)
+        return 0
+
+    def get(self, key):
+        """Return the CachedResponse for key, fresh or stale, or None"""
+        entry = self.memory.get(key)
+        if entry:
+            self.memory.move_to_end(key)
+            return entry
+        if not self.db:
+            return None
+        row = self.db.execute('SELECT status, headers, content, stored, expires FROM responses WHERE key = ?',
+                              (self.db_key(key),)).fetchone()
+        if not row:
+            return None
+        self.db.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), self.db_key(key)))
+        status, headers, content, stored, expires = row
+        entry = CachedResponse(key, status, json.loads(headers), content, stored, expires)
+        self.remember(key, entry)
+        return entry
+
+    def put(self, key, url, status_code, headers, content, ttl=None):
+        """Store a response if its headers allow it. ttl overrides the freshness given by the headers.
+
+        :return: the CachedResponse stored, or None
+        """
+        headers = {name.lower(): value for name, value in headers.items() if name.lower() in STORED_HEADERS}
+        now = time.time()
+        freshness = self.freshness(headers, now)
+        if freshness is None or len(content) > self.max_entry_bytes:
+            self.remove(key)
+            return None
+        if ttl is not None:
+            freshness = ttl
+        if not freshness and 'etag' not in headers and 'last-modified' not in headers:
+            # Would be stale right away and can't be revalidated
+            self.remove(key)
+            return None
+        entry = CachedResponse(url, status_code, headers, content, now, now + freshness)
+        self.remember(key, entry)
+        if self.db:
+            self.remove_stored(key)
+            self.db.execute('INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (self.db_key(key), self.redact_url(url), status_code, json.dumps(headers), content,
+                             entry.size, now, entry.expires, now))
+            self.disk_entries += 1
+            self.disk_bytes += entry.size
+            self.evict()
+        return entry
+
+    def refresh(self, key, entry, headers, ttl=None):
+        """Mark entry fresh again after the server answered 304 Not Modified with headers"""
+        headers = {name.lower(): value for name, value in headers.items() if name.lower() in STORED_HEADERS}
+        entry.headers.update(headers)
+        now = time.time()
+        freshness = self.freshness(entry.headers, now)
+        if ttl is not None:
+            freshness = ttl
+        entry.stored = now
+        entry.expires = now + (freshness or 0)
+        self.revalidations += 1
+        if self.db:
+            self.db.execute('UPDATE responses SET headers = ?, stored = ?, expires = ?, last_used = ? WHERE key = ?',
+                            (json.dumps(entry.headers), now, entry.expires, now, self.db_key(key)))
+
+    def remember(self, key, entry):
+        old = self.memory.pop(key, None)
+        if old:
+            self.memory_used -= old.size
+        self.memory[key] = entry
+        self.memory_used += entry.size
+        while self.memory_used > self.memory_bytes and self.memory:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_used -= evicted.size
+
+    def remove(self, key):
+        old = self.memory.pop(key, None)
+        if old:
+            self.memory_used -= old.size
+        if self.db:
+            self.remove_stored(key)
+
+    def remove_stored(self, key):
+        row = self.db.execute('SELECT size FROM responses WHERE key = ?', (self.db_key(key),)).fetchone()
+        if row:
+            self.db.execute('DELETE FROM responses WHERE key = ?', (self.db_key(key),))
+            self.disk_entries -= 1
+            self.disk_bytes -= row[0]
+
+    def clear(self):
+        self.memory.clear()
+        self.memory_used = 0
+        if self.db:
+            self.db.execute('DELETE FROM responses')
+            self.disk_entries = self.disk_bytes = 0
+
+    def evict(self):
+        over_bytes = self.disk_bytes - self.max_bytes if self.max_bytes else 0
+        if over_bytes <= 0:
+            return
+        evict_keys = []
+        for key, size in self.db.execute('SELECT key, size FROM responses ORDER BY last_used'):
+            if over_bytes <= 0:
+                break
+            evict_keys.append((key,))
+            over_bytes -= size
+            self.disk_bytes -= size
+        self.db.executemany('DELETE FROM responses WHERE key = ?', evict_keys)
+        self.disk_entries -= len(evict_keys)
+        self.evictions += len(evict_keys)
+        self.logger.debug(f'Evicted {len(evict_keys)} responses from HTTP cache')
+
+    def stats(self):
+        if self.db:
+            entries, total_bytes = self.disk_entries, self.disk_bytes
+        else:
+            entries, total_bytes = len(self.memory), self.memory_used
+        return {
+            'entries': entries,
+            'bytes': total_bytes,
+            'memory_bytes': self.memory_used,
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+            'evictions': self.evictions,
+        }
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
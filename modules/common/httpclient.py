@@ -0,0 +1,156 @@
+import asyncio
+import contextlib
+import logging
+
+import httpx
+
+from modules.common.singleflight import SingleFlight
+
+try:
+    import h2  # noqa: F401 httpx needs it for HTTP/2
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+
+class HttpClient:
+    """Async HTTP client shared by the bot and all modules
+
+    Wraps one httpx.AsyncClient, so connections (and TLS sessions) to the same hosts are kept
+    alive and reused. Uses HTTP/2 if the h2 package is installed. At most max_connections
+    connections are open in total, and at most max_per_host requests run to a single host at a
+    time. Requests follow redirects and time out after timeout seconds by default.
+
+    httpx only supports disabling certificate verification per client, so requests with
+    verify=False go through a second client that is created when first needed.
+
+    GET requests made with cache=True use the HttpCache, if the bot has one: responses are
+    reused as long as the server allows, and revalidated with conditional requests after
+    that. cache=<seconds> keeps responses fresh for that long, whatever the server says.
+    Concurrent cached requests for the same url share one request.
+
+    Modules get it as self.http. Example:
+
+        response = await self.http.get(url, params={'q': query}, cache=3600)
+        response.raise_for_status()
+        data = response.json()
+    """
+
+    shared = None  # Instance used by modules, set by the bot
+
+    def __init__(self, max_connections=100, max_per_host=10, timeout=30.0, user_agent=None, cache=None):
+        self.logger = logging.getLogger("hemppa.httpclient")
+        self.cache = cache  # HttpCache or None
+        self.singleflight = SingleFlight()
+        self.max_per_host = max_per_host
+        self.host_semaphores = dict()  # Host -> [asyncio.Semaphore, requests using it], while in use
+        self.options = dict(http2=HTTP2,
+                            limits=httpx.Limits(max_connections=max_connections or None,
+                                                max_keepalive_connections=20,
+                                                keepalive_expiry=30.0),
+                            timeout=httpx.Timeout(timeout),
+                            follow_redirects=True,
+                            headers={'User-Agent': user_agent} if user_agent else None)
+        self.client = httpx.AsyncClient(**self.options)
+        self.insecure_client = None  # Client that doesn't verify certificates
+
+    @classmethod
+    def get_shared(cls):
+        if cls.shared is None:
+            cls.shared = cls()
+        return cls.shared
+
+    @contextlib.asynccontextmanager
+    async def host_slot(self, url):
+        """Wait until fewer than max_per_host requests run to url's host. Semaphores of idle hosts are dropped."""
+        host = httpx.URL(url).host
+        slot = self.host_semaphores.get(host)
+        if slot is None:
+            slot = self.host_semaphores[host] = [asyncio.Semaphore(self.max_per_host), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                yield
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self.host_semaphores[host]
+
+    def client_for(self, verify):
+        if verify:
+            return self.client
+        if self.insecure_client is None:
+            self.insecure_client = httpx.AsyncClient(verify=False, **self.options)
+        return self.insecure_client
+
+    async def request(self, method, url, verify=True, cache=False, **kwargs):
+        """Send a request and read the response. Takes the arguments of httpx.AsyncClient.request().
+
+        :param verify: False to skip certificate verification
+        :param cache: True to cache GET responses as the server allows, or seconds to cache them for
+        :return: httpx.Response
+        """
+        if cache is not False and cache is not None and method == 'GET' and self.cache is not None:
+            headers = kwargs.get('headers') or {}
+            if not any(name.lower() in ('authorization', 'cookie') for name in headers):
+                key = str(httpx.URL(url, params=kwargs.pop('params', None)))
+                # A request that verifies certificates must not get the response of one that doesn't
+                return await self.singleflight.do((key, verify), self.cached_get, key, verify,
+                                                  None if cache is True else cache, kwargs)
+        return await self.send(method, url, verify, **kwargs)
+
+    async def send(self, method, url, verify, **kwargs):
+        client = self.client_for(verify)
+        if not self.max_per_host:
+            return await client.request(method, url, **kwargs)
+        async with self.host_slot(url):
+            return await client.request(method, url, **kwargs)
+
+    async def cached_get(self, key, verify, ttl, kwargs):
+        entry = self.cache.get(key)
+        if entry and entry.fresh():
+            self.cache.hits += 1
+            return self.cached_response(entry)
+        self.cache.misses += 1
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry:
+            headers.update(entry.validators())
+        response = await self.send('GET', key, verify, headers=headers, **kwargs)
+        if entry and response.status_code == 304:
+            self.cache.refresh(key, entry, response.headers, ttl)
+            return self.cached_response(entry)
+        if response.status_code == 200:
+            self.cache.put(key, str(response.url), response.status_code, response.headers, response.content, ttl)
+        return response
+
+    @staticmethod
+    def cached_response(entry):
+        return httpx.Response(entry.status_code, headers=entry.headers, content=entry.content,
+                              request=httpx.Request('GET', entry.url))
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def stream(self, method, url, verify=True, **kwargs):
+        """Send a request and stream the response, like httpx.AsyncClient.stream()"""
+        client = self.client_for(verify)
+        if not self.max_per_host:
+            async with client.stream(method, url, **kwargs) as response:
+                yield response
+            return
+        async with self.host_slot(url):
+            async with client.stream(method, url, **kwargs) as response:
+                yield response
+
+    async def aclose(self):
+        await self.client.aclose()
+        if self.insecure_client:
+            await self.insecure_client.aclose()
+            self.insecure_client = None
+        if HttpClient.shared is self:
+            HttpClient.shared = None
@@ -0,0 +1,99 @@
+import tempfile
+
+from PIL import ImageFile
+
+# Image headers are normally in the first few kilobytes, but e.g. JPEG EXIF data can be large
+HEADER_MAX_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+def image_size(data):
+    """Read width and height of an image from its header, without decoding the image
+
+    :param data: image content, or at least the beginning of it
+    :return: (width, height), or (None, None) if the image type is not recognized
+    """
+    parser = ImageFile.Parser()
+    try:
+        for pos in range(0, min(len(data), HEADER_MAX_SIZE), CHUNK_SIZE):
+            parser.feed(data[pos:pos + CHUNK_SIZE])
+            if parser.image:
+                return parser.image.size
+    except OSError:
+        pass
+    return (None, None)
+
+
+class ImageStream:
+    """Passes image data from a streaming http response to an upload
+
+    Reads image dimensions from the header while the data passes through, and keeps a copy of the
+    data in a spooled temporary file so that the upload can be restarted if the homeserver asks to retry.
+
+    Use data_provider as the data provider of nio AsyncClient.upload().
+    """
+
+    def __init__(self, response, max_size):
+        """
+        :param response: a httpx streaming response
+        :param max_size: maximum size of the image in bytes
+        """
+        self.source = response.aiter_bytes()
+        self.max_size = max_size
+        self.size = 0
+        self.finished = False
+        self.too_large = False
+        self.width = None
+        self.height = None
+        self.parser = ImageFile.Parser()
+        self.spool = tempfile.SpooledTemporaryFile(max_size=HEADER_MAX_SIZE)
+
+    def add(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            self.too_large = True
+            raise ImageTooLarge(f'Image is larger than {self.max_size} bytes')
+        self.spool.write(chunk)
+        if self.parser and self.size <= HEADER_MAX_SIZE:
+            try:
+                self.parser.feed(chunk)
+            except OSError:
+                self.parser = None
+                return
+            if self.parser.image:
+                self.width, self.height = self.parser.image.size
+                # Got what we need, don't let the parser decode the rest of the image
+                self.parser = None
+
+    async def stream(self):
+        async for chunk in self.source:
+            self.add(chunk)
+            yield chunk
+        self.finished = True
+
+    async def read_all(self):
+        """Download the whole image into the spool"""
+        async for chunk in self.stream():
+            pass
+
+    async def replay(self):
+        await self.read_all()
+        self.spool.seek(0)
+        while True:
+            chunk = self.spool.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def data_provider(self, got_429, got_timeouts):
+        if self.size == 0 and not self.finished:
+            return self.stream()
+        # Retrying, or the image was downloaded before uploading
+        return self.replay()
+
+    def close(self):
+        self.spool.close()
@@ -0,0 +1,147 @@
+import ast
+import logging
+
+from modules.common.module import BotModule
+
+# Base classes of modules that can be loaded lazily. Others (e.g. PollingService) poll.
+LAZY_BASES = {'BotModule', 'SubBotModule'}
+# Methods that must run at startup, so modules defining them are loaded at startup
+EAGER_METHODS = {'matrix_poll', 'sync_event_types'}
+# Calls in __init__ or matrix_start that register something with the bot or start something running,
+# so they must be called at startup
+EAGER_CALLS = {'subscribe', 'add_event_callback', 'add_response_callback', 'add_to_device_callback',
+               'add_global_account_data_callback', 'update_commands', 'addHandler',
+               'create_task', 'ensure_future', 'run_until_complete', 'set_subscription_rooms'}
+
+
+class ModuleManifest:
+    """What is known about a module without importing it
+
+    Found by parsing the module source. lazy is True if the module only needs to be imported
+    when it is first used: it doesn't poll, subscribe to events or register anything at startup.
+    """
+
+    def __init__(self, name, help=None, aliases=None, enabled=True, lazy=False):
+        self.name = name
+        self.help = help  # Constant returned by help(), or None
+        self.aliases = aliases or []  # Constant aliases added in matrix_start
+        self.enabled = enabled  # Default for enabled, set in __init__
+        self.lazy = lazy
+
+    @classmethod
+    def scan(cls, name, path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                tree = ast.parse(f.read(), path)
+        except (OSError, SyntaxError, ValueError):
+            return cls(name)
+
+        module_class = next((node for node in tree.body
+                             if isinstance(node, ast.ClassDef) and node.name == 'MatrixModule'), None)
+        if module_class is None:
+            return cls(name)
+
+        manifest = cls(name, lazy=True)
+        bases = [base.id if isinstance(base, ast.Name) else getattr(base, 'attr', None) for base in module_class.bases]
+        if not bases or any(base not in LAZY_BASES for base in bases):
+            manifest.lazy = False
+
+        for node in module_class.body:
+            if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                continue
+            if node.name in EAGER_METHODS:
+                manifest.lazy = False
+            elif node.name == 'help':
+                manifest.help = cls.returned_constant(node)
+            elif node.name == '__init__':
+                manifest.enabled = cls.assigned_enabled(node, manifest.enabled)
+                manifest.lazy = manifest.lazy and cls.scan_start(node, [])
+            elif node.name == 'matrix_start':
+                manifest.lazy = manifest.lazy and cls.scan_start(node, manifest.aliases)
+        return manifest
+
+    @staticmethod
+    def returned_constant(function):
+        for node in function.body:
+            if isinstance(node, ast.Return) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+                return node.value.value
+        return None
+
+    @staticmethod
+    def assigned_enabled(function, default):
+        for node in ast.walk(function):
+            if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant):
+                for target in node.targets:
+                    if isinstance(target, ast.Attribute) and target.attr == 'enabled':
+                        default = bool(node.value.value)
+        return default
+
+    @staticmethod
+    def scan_start(function, aliases):
+        """Collect constant aliases added in function. Returns False if it must be called at startup."""
+        for node in ast.walk(function):
+            if isinstance(node, ast.Attribute) and node.attr == 'module_aliases':
+                return False
+            if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Attribute):
+                continue
+            if node.func.attr in EAGER_CALLS:
+                return False
+            if node.func.attr == 'add_module_aliases':
+                names = node.args[1] if len(node.args) > 1 else None
+                if node.keywords or not isinstance(names, (ast.List, ast.Tuple)) or \
+                        not all(isinstance(name, ast.Constant) and isinstance(name.value, str) for name in names.elts):
+                    return False
+                aliases.extend(name.value for name in names.elts)
+        return True
+
+
+class LazyModule(BotModule):
+    """Stands in for a module that hasn't been imported yet
+
+    Answers help, settings and enabled state from the manifest and stored settings.
+    The module is imported with activate(name) on first command, or whenever
+    something else is needed from it, and replaces this in Bot.modules.
+    """
+
+    def __init__(self, manifest, activate):
+        super().__init__(manifest.name)
+        self.manifest = manifest
+        self.activate = activate
+        self.enabled = manifest.enabled
+        self.settings = None  # Settings to pass to the module when it's loaded
+        self.started = False
+
+    def matrix_start(self, bot):
+        self.started = True
+        if self.manifest.aliases:
+            self.add_module_aliases(bot, self.manifest.aliases)
+
+    def matrix_stop(self, bot):
+        self.started = False
+
+    async def matrix_message(self, bot, room, event):
+        await self.activate(self.name).matrix_message(bot, room, event)
+
+    def help(self):
+        if self.manifest.help is not None:
+            return self.manifest.help
+        return self.activate(self.name).help()
+
+    def long_help(self, bot=None, room=None, event=None, args=[]):
+        return self.activate(self.name).long_help(bot=bot, room=room, event=event, args=args)
+
+    def get_settings(self):
+        data = dict(self.settings or {})
+        data['enabled'] = self.enabled
+        return data
+
+    def set_settings(self, data):
+        self.settings = data
+        super().set_settings(data)
+
+    def __getattr__(self, name):
+        # Called only for attributes a LazyModule doesn't have, so it's something module specific
+        if name.startswith('__') or 'activate' not in self.__dict__:
+            raise AttributeError(name)
+        logging.getLogger("hemppa.lazymodule").debug(f'{self.name}.{name} needed, loading module')
+        return getattr(self.activate(self.name), name)
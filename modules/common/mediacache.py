@@ -0,0 +1,197 @@
+import contextlib
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+
+
+class MediaCache:
+    """Persistent cache of media uploaded to the homeserver
+
+    Maps an image source (url, or hash of the image content) to the details of the uploaded
+    file: [matrix_uri, mimetype, width, height, size]. Stored in a local SQLite database.
+
+    Least recently used entries are evicted when the cache has more than max_entries entries,
+    or the cached files add up to more than max_bytes. Entries older than ttl seconds expire.
+    Zero means no limit.
+
+    Lookups don't write to the database: last used times are kept in memory and written
+    in batches of flush_after, and before evicting. Entry count and total size are kept
+    as running totals.
+    """
+
+    flush_after = 100
+
+    def __init__(self, path, max_entries=1000, max_bytes=0, ttl=0):
+        self.logger = logging.getLogger("hemppa.mediacache")
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.touched = dict()  # Key -> last used time, not written yet
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute('CREATE TABLE IF NOT EXISTS media (key TEXT PRIMARY KEY, matrix_uri TEXT, mimetype TEXT, '
+                        'width INTEGER, height INTEGER, size INTEGER, created REAL, last_used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS media_last_used ON media (last_used)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS media_created ON media (created)')
+        self.entries, self.total_bytes = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM media').fetchone()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        if self.db.in_transaction:
+            yield
+            return
+        self.db.execute('BEGIN')
+        try:
+            yield
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def flush(self):
+        """Write last used times of entries looked up since the last flush"""
+        if not self.touched:
+            return
+        touched, self.touched = self.touched, dict()
+        with self.transaction():
+            self.db.executemany('UPDATE media SET last_used = ? WHERE key = ?',
+                                [(last_used, key) for key, last_used in touched.items()])
+
+    @staticmethod
+    def blob_key(blob):
+        """Cache key for binary content"""
+        return 'blake2b:' + hashlib.blake2b(blob, digest_size=32).hexdigest()
+
+    def get(self, key):
+        """Return [matrix_uri, mimetype, w, h, size] for key, or None if not cached"""
+        row = self.db.execute('SELECT matrix_uri, mimetype, width, height, size, created FROM media WHERE key = ?', (key,)).fetchone()
+        now = time.time()
+        if row and self.ttl and now - row[5] > self.ttl:
+            self.remove(key)
+            self.expirations += 1
+            row = None
+        if not row:
+            self.misses += 1
+            return None
+        self.touched[key] = now
+        if len(self.touched) >= self.flush_after:
+            self.flush()
+        self.hits += 1
+        return list(row[:5])
+
+    def put(self, key, details, evict=True):
+        matrix_uri, mimetype, w, h, size = details
+        now = time.time()
+        self.remove(key)
+        self.db.execute('INSERT INTO media VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (key, matrix_uri, mimetype, w, h, size or 0, now, now))
+        self.entries += 1
+        self.total_bytes += size or 0
+        if evict:
+            self.evict()
+
+    def remove(self, key):
+        self.touched.pop(key, None)
+        row = self.db.execute('SELECT size FROM media WHERE key = ?', (key,)).fetchone()
+        if row:
+            self.db.execute('DELETE FROM media WHERE key = ?', (key,))
+            self.entries -= 1
+            self.total_bytes -= row[0] or 0
+
+    def remove_prefix(self, prefix):
+        """Remove entries whose key starts with prefix, e.g. images from one site. Returns the number removed."""
+        where = 'substr(key, 1, ?) = ?'
+        params = (len(prefix), prefix)
+        count, size = self.db.execute(f'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM media WHERE {where}',
+                                      params).fetchone()
+        if count:
+            self.db.execute(f'DELETE FROM media WHERE {where}', params)
+            self.entries -= count
+            self.total_bytes -= size
+            for key in [key for key in self.touched if key.startswith(prefix)]:
+                del self.touched[key]
+        return count
+
+    def clear(self):
+        self.touched.clear()
+        self.db.execute('DELETE FROM media')
+        self.entries = self.total_bytes = 0
+
+    def evict(self):
+        if self.ttl:
+            expired = time.time() - self.ttl
+            count, size = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM media WHERE created < ?',
+                                          (expired,)).fetchone()
+            if count:
+                self.db.execute('DELETE FROM media WHERE created < ?', (expired,))
+                self.entries -= count
+                self.total_bytes -= size
+                self.expirations += count
+
+        over_entries = self.entries - self.max_entries if self.max_entries else 0
+        over_bytes = self.total_bytes - self.max_bytes if self.max_bytes else 0
+        if over_entries <= 0 and over_bytes <= 0:
+            return
+
+        # Eviction order depends on last used times
+        self.flush()
+        evict_keys = []
+        for key, size in self.db.execute('SELECT key, size FROM media ORDER BY last_used'):
+            if over_entries <= 0 and over_bytes <= 0:
+                break
+            evict_keys.append((key,))
+            over_entries -= 1
+            over_bytes -= size
+            self.total_bytes -= size
+            self.touched.pop(key, None)
+        self.db.executemany('DELETE FROM media WHERE key = ?', evict_keys)
+        self.entries -= len(evict_keys)
+        self.evictions += len(evict_keys)
+        self.logger.debug(f'Evicted {len(evict_keys)} entries from media cache')
+
+    def import_entries(self, entries):
+        """Import entries from the old uri_cache dict (key -> [matrix_uri, mimetype, w, h, size])"""
+        count = 0
+        with self.transaction():
+            for key, details in entries.items():
+                # Old cache used md5 of the content as key for blobs, which can't be matched anymore
+                if len(key) == 32 and all(c in '0123456789abcdef' for c in key):
+                    continue
+                try:
+                    self.put(key, details, evict=False)
+                    count += 1
+                except (TypeError, ValueError):
+                    self.logger.warning(f'Skipping broken uri cache entry {key}')
+            self.evict()
+        return count
+
+    def items(self, limit=None):
+        """Return (key, matrix_uri) pairs, most recently used first"""
+        self.flush()
+        query = 'SELECT key, matrix_uri FROM media ORDER BY last_used DESC'
+        if limit:
+            query += f' LIMIT {int(limit)}'
+        return self.db.execute(query).fetchall()
+
+    def stats(self):
+        return {
+            'entries': self.entries,
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+    def close(self):
+        self.flush()
+        self.db.close()
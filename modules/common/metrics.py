@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import math
+
+from aiohttp import web
+
+# Upper bounds of latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Metrics:
+    """Counters, gauges and histograms, served over HTTP in Prometheus text format
+
+    Metrics are recorded with inc(), set() and observe(), with an optional dict of labels.
+    Values that are already counted elsewhere (e.g. queue statistics) are read only when
+    metrics are requested, by collector functions added with add_collector(). A collector
+    returns a list of (name, labels, value) tuples. Declare the type and help text of
+    metrics with describe().
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("hemppa.metrics")
+        self.descriptions = dict()  # Name -> (type, help)
+        self.values = dict()  # Name -> {labels tuple -> number or Histogram}
+        self.collectors = []
+        self.runner = None
+        self.monitor_task = None
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def describe(self, name, metric_type, help_text):
+        self.descriptions[name] = (metric_type, help_text)
+
+    @staticmethod
+    def label_key(labels):
+        return tuple(sorted(labels.items())) if labels else ()
+
+    def inc(self, name, value=1, labels=None):
+        samples = self.values.setdefault(name, dict())
+        key = self.label_key(labels)
+        samples[key] = samples.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        self.values.setdefault(name, dict())[self.label_key(labels)] = value
+
+    def observe(self, name, value, labels=None, buckets=DEFAULT_BUCKETS):
+        samples = self.values.setdefault(name, dict())
+        key = self.label_key(labels)
+        histogram = samples.get(key)
+        if histogram is None:
+            histogram = samples[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    @staticmethod
+    def format_labels(key, extra=None):
+        labels = list(key) + (extra or [])
+        if not labels:
+            return ''
+        escaped = (name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                   for name, value in labels)
+        return '{' + ','.join(escaped) + '}'
+
+    @staticmethod
+    def format_value(value):
+        if isinstance(value, float) and math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+    def render(self):
+        """Return all metrics in Prometheus text exposition format"""
+        values = {name: dict(samples) for name, samples in self.values.items()}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    values.setdefault(name, dict())[self.label_key(labels)] = value
+            except Exception:
+                self.logger.exception(f'unhandled exception from metrics collector {collector}')
+
+        lines = []
+        for name in sorted(values):
+            metric_type, help_text = self.descriptions.get(name, ('untyped', None))
+            if help_text:
+                lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for key, value in sorted(values[name].items()):
+                if isinstance(value, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(value.buckets, value.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{self.format_labels(key, [("le", bound)])} {cumulative}')
+                    lines.append(f'{name}_bucket{self.format_labels(key, [("le", "+Inf")])} {value.count}')
+                    lines.append(f'{name}_sum{self.format_labels(key)} {self.format_value(value.sum)}')
+                    lines.append(f'{name}_count{self.format_labels(key)} {value.count}')
+                else:
+                    lines.append(f'{name}{self.format_labels(key)} {self.format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    async def handle(self, request):
+        return web.Response(text=self.render(), content_type='text/plain')
+
+    async def monitor_loop(self, interval=0.5):
+        """Measure how late the event loop wakes up from sleep, which is time it was blocked"""
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag = max(loop.time() - start - interval, 0.0)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.observe('hemppa_event_loop_lag_seconds', lag)
+            self.inc('hemppa_event_loop_blocked_seconds_total', lag)
+
+    async def start(self, host, port):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host=host, port=port)
+        await site.start()
+        self.logger.info(f'Serving metrics at http://{host}:{port}/metrics')
+
+    def start_monitor(self):
+        """Start measuring event loop lag, whether or not metrics are served"""
+        if not self.monitor_task:
+            self.monitor_task = asyncio.get_event_loop().create_task(self.monitor_loop())
+
+    def stop_monitor(self):
+        if self.monitor_task:
+            self.monitor_task.cancel()
+            self.monitor_task = None
+
+    def lag_stats(self):
+        """Return last and max event loop lag and total time blocked, in seconds"""
+        blocked = self.values.get('hemppa_event_loop_blocked_seconds_total', dict()).get((), 0.0)
+        return {'last': self.last_lag, 'max': self.max_lag, 'blocked': blocked}
+
+    async def stop(self):
+        self.stop_monitor()
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
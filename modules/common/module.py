@@ -4,6 +4,10 @@ import inspect
 
 from nio import RoomMessageText, MatrixRoom
 
+from modules.common.blocking import BlockingRunner
+from modules.common.httpclient import HttpClient
+from modules.common.singleflight import SingleFlight
+
 class ModuleCannotBeDisabled(Exception):
     pass
 
@@ -34,6 +38,13 @@ class BotModule(ABC):
         self.enabled = True
         self.name = name
         self.logger = logging.getLogger("module " + self.name)
+        self.poll_interval = 10  # Seconds between matrix_poll calls
+        self.poll_jitter = 0  # Random delay of up to this many seconds added to each poll
+        self.poll_cron = None  # Cron expression (e.g. '*/5 * * * *') to poll on, instead of poll_interval
+        self.blocking_limit = 2  # Max run_blocking calls running or waiting at a time
+        self.blocking_timeout = 60  # Default timeout of run_blocking, in seconds
+        self.blocking_runner = None
+        self.singleflight = None
 
     def matrix_start(self, bot):
         """Called once on startup
@@ -63,17 +74,69 @@ class BotModule(ABC):
         :type bot: Bot
         """
         self.logger.info('Stopping..')
+        if self.blocking_runner:
+            self.blocking_runner.cancel()
+
+    @property
+    def http(self):
+        """HTTP client shared by the bot and all modules, see HttpClient
+
+        Use this instead of requests, urllib or a client of your own, so connections are reused.
+        """
+        return HttpClient.get_shared()
+
+    async def run_blocking(self, func, *args, timeout=None, process=False, **kwargs):
+        """Run a blocking function (e.g. a library doing network requests) without blocking the bot
+
+        Runs func(*args, **kwargs) in a shared thread pool, or in a process pool if process is True
+        (then func and its arguments must be picklable), and returns what it returns. At most
+        blocking_limit calls of this module run at a time, others wait for their turn.
+        Waiting is cancelled in matrix_stop, which raises BlockingCancelled.
+
+        :param timeout: seconds to wait, blocking_timeout by default. Raises asyncio.TimeoutError on timeout.
+        :param process: run in a process pool, for CPU heavy work
+        """
+        if self.blocking_runner is None:
+            self.blocking_runner = BlockingRunner(self.name, self.blocking_limit, self.blocking_timeout)
+        return await self.blocking_runner.run(func, *args, timeout=timeout, process=process, **kwargs)
+
+    async def coalesce(self, key, func, *args, **kwargs):
+        """Await func(*args, **kwargs), sharing the call with others of this module with the same key
+
+        While a call with key is running, e.g. fetching the same resource for several rooms
+        or users at once, other calls with that key wait for it and get its result (or
+        exception) instead of running func again.
+
+        :param key: hashable identifying the call, e.g. the url to fetch
+        :param func: coroutine function
+        """
+        if self.singleflight is None:
+            self.singleflight = SingleFlight()
+        return await self.singleflight.do(key, func, *args, **kwargs)
 
     async def matrix_poll(self, bot, pollcount):
-        """Called every 10 seconds
+        """Called every poll_interval seconds, or on the poll_cron schedule if set
+
+        Modules that don't implement this are not polled at all.
 
         :param bot: a reference to the bot
         :type bot: Bot
-        :param pollcount: the actual poll count
+        :param pollcount: number of times this module has been polled, 1 on the first poll
         :type pollcount: int
         """
         pass
 
+    def sync_event_types(self):
+        """Return event types this module needs to receive, besides m.room.message and room state events
+
+        Used to build the sync filter when SYNC_FILTER is enabled. Override if you
+        add event callbacks for other event types.
+
+        :return: a list of event types, e.g. ['m.reaction']
+        :rtype: list
+        """
+        return []
+
     @abstractmethod
     def help(self):
         """Return one-liner help text"""
@@ -107,6 +170,24 @@ class BotModule(ABC):
         if data.get('enabled') is not None:
             self.enabled = data['enabled']
 
+    def get_state(self):
+        """Return in-memory state to carry over when this module is reloaded with !bot reload module
+
+        Use for things that are not saved in settings, e.g. caches or data collected between polls.
+
+        :return: any object that the new version of the module understands in set_state, or None
+        """
+        return None
+
+    def set_state(self, state):
+        """Take over state returned by get_state of the previous version of this module
+
+        Called after set_settings and before matrix_start.
+
+        :param state: object returned by get_state
+        """
+        pass
+
     def add_module_aliases(self, bot, args, force=False):
         """Add a list of aliases for this module.
 
@@ -128,6 +209,7 @@ class BotModule(ABC):
             if prev:
                 self.logger.debug(f"overriding alias {name} for {prev}")
             bot.module_aliases[name] = self.name
+        bot.update_commands()
 
     def enable(self):
         self.enabled = True
@@ -142,10 +224,13 @@ class SubBotModule(BotModule):
         super().__init__(name)
         self.sub_commands = set()
         self.sub_command_aliases = {'help': 'module_help'}
+        self.sub_command_table = dict()  # Subcommand or alias -> method
 
     def _load_subcommands(self):
         self.sub_commands = set([x for x in dir(self)
                                 if getattr(getattr(self, x), '_is_subcommand', None)])
+        self.sub_command_table = {name: self.__get_command(name)
+                                  for name in self.sub_commands.union(self.sub_command_aliases.keys())}
 
     def __get_command(self, name):
         name = self.sub_command_aliases.get(name) or name
@@ -155,10 +240,9 @@ class SubBotModule(BotModule):
         # Dispatch to subcommand functions:
         args = event.body.split()
         args.pop(0)
-        if len(args) > 0 and args[0] in \
-           self.sub_commands.union(set(self.sub_command_aliases.keys())):
-            await self.__get_command(args[0])(bot, room, event, args)
-            return
+        command = self.sub_command_table.get(args[0]) if len(args) > 0 else None
+        if command:
+            await command(bot, room, event, args)
         else:
             await self.module_help(bot, room, event, args)
 
@@ -1,3 +1,4 @@
+import asyncio
 from datetime import datetime, timedelta
 from random import randrange
 
@@ -5,6 +6,13 @@ from modules.common.module import BotModule
 
 
 class PollingService(BotModule):
+    """Base for modules that poll accounts of some service, per room
+
+    Rooms due for polling are polled concurrently. Accounts followed in several rooms can be
+    fetched once for all of them by doing the fetch in poll_implementation with
+    self.coalesce(account, fetch_function, ...).
+    """
+
     def __init__(self, name):
         super().__init__(name)
         self.known_ids = set()
@@ -15,6 +23,8 @@ class PollingService(BotModule):
         self.poll_interval_random = 30
         self.owner_only = False # Set to true if service can be run only by bot owner
         self.send_all = False # Set to true to send all received items, even on first sync
+        self.poll_interval = 60  # Rooms are polled every poll_interval_min minutes, no need to check more often
+        self.poll_jitter = 30
 
     async def matrix_poll(self, bot, pollcount):
         if self.enabled and len(self.account_rooms):
@@ -23,6 +33,7 @@ class PollingService(BotModule):
     async def poll_all_accounts(self, bot):
         now = datetime.now()
         delete_rooms = []
+        polls = []
         for roomid in self.account_rooms:
             if roomid in bot.client.rooms:
                 send_messages = True
@@ -33,19 +44,29 @@ class PollingService(BotModule):
                         send_messages = False
                         self.logger.debug(f'Polling all accounts for room {roomid} - but this is first sync so I wont send messages')
                 if now >= self.next_poll_time.get(roomid):
-                    accounts = self.account_rooms[roomid]
-                    for account in accounts:
-                        await self.poll_account(bot, account, roomid, send_messages)
+                    polls.append(self.poll_room(bot, roomid, list(self.account_rooms[roomid]), send_messages))
             else:
                 self.logger.warning(f'Bot is no longer in room {roomid} - deleting it from {self.service_name} room list')
                 delete_rooms.append(roomid)
 
+        results = await asyncio.gather(*polls, return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        for error in errors[1:]:
+            self.logger.error(f'Polling {self.service_name} failed', exc_info=error)
+
         if len(delete_rooms):
             for roomid in delete_rooms:
                 self.account_rooms.pop(roomid, None)
             bot.save_settings()
 
         self.first_run = False
+        if errors:
+            # Let the bot handle the first one like any poll failure
+            raise errors[0]
+
+    async def poll_room(self, bot, roomid, accounts, send_messages):
+        for account in accounts:
+            await self.poll_account(bot, account, roomid, send_messages)
 
     async def poll_implementation(self, bot, account, roomid, send_messages):
         pass
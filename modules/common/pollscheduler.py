@@ -0,0 +1,174 @@
+import heapq
+import itertools
+import logging
+import random
+from datetime import datetime, timedelta
+
+
+class CronTab:
+    """Minimal cron expression: minute hour day-of-month month day-of-week
+
+    Fields support *, numbers, ranges (1-5), steps (*/15, 0-30/10) and lists (1,15).
+    Day of week is 0-7, where both 0 and 7 are Sunday. The @hourly, @daily, @weekly,
+    @monthly and @yearly shorthands are also accepted. Times are in local time.
+    """
+
+    shorthands = {
+        '@hourly': '0 * * * *',
+        '@daily': '0 0 * * *',
+        '@weekly': '0 0 * * 0',
+        '@monthly': '0 0 1 * *',
+        '@yearly': '0 0 1 1 *',
+    }
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = self.shorthands.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ValueError(f'Cron expression must have 5 fields: {expression}')
+        self.minutes = self.parse_field(fields[0], 0, 59)
+        self.hours = self.parse_field(fields[1], 0, 23)
+        self.days = self.parse_field(fields[2], 1, 31)
+        self.months = self.parse_field(fields[3], 1, 12)
+        self.weekdays = set(day % 7 for day in self.parse_field(fields[4], 0, 7))
+        # Like in cron, if both day fields are restricted, either one matching is enough
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def parse_field(field, minimum, maximum):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = int(step)
+                if step < 1:
+                    raise ValueError(f'Invalid step in cron field {field}')
+            if part == '*':
+                start, end = minimum, maximum
+            elif '-' in part:
+                start, end = (int(value) for value in part.split('-', 1))
+            else:
+                start = int(part)
+                end = maximum if step > 1 else start
+            if start < minimum or end > maximum or start > end:
+                raise ValueError(f'Cron field {field} out of range {minimum}-{maximum}')
+            values.update(range(start, end + 1, step))
+        return values
+
+    def day_matches(self, t):
+        day = t.day in self.days
+        # datetime weekday() is 0 for Monday, cron uses 0 for Sunday
+        weekday = (t.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_time(self, after):
+        """Return the first matching time after the given datetime"""
+        t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=5 * 366)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t = t + timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f'Cron expression never matches: {self.expression}')
+
+
+class ScheduledPoll:
+    def __init__(self, modulename, moduleobject, due):
+        self.modulename = modulename
+        self.moduleobject = moduleobject
+        self.interval = max(moduleobject.poll_interval, 1)
+        self.jitter = moduleobject.poll_jitter
+        self.cron = None
+        self.base = due  # Due time without jitter, keeps the cadence from drifting
+        self.due = due
+        self.pollcount = 0
+
+
+class PollScheduler:
+    """Decides when each module's matrix_poll is due
+
+    Modules declare poll_interval (seconds), poll_jitter (seconds) and optionally
+    poll_cron (cron expression, overrides the interval). Pending polls are kept in
+    a heap ordered by due time, so only modules that are due are woken up.
+    Times are event loop times (loop.time()).
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("hemppa.pollscheduler")
+        self.heap = []
+        self.counter = itertools.count()  # Tie breaker for polls due at the same time
+
+    def clear(self):
+        self.heap = []
+
+    def add(self, modulename, moduleobject, now, pollcount=0):
+        poll = ScheduledPoll(modulename, moduleobject, now)
+        poll.pollcount = pollcount
+        if moduleobject.poll_cron:
+            try:
+                poll.cron = CronTab(moduleobject.poll_cron)
+            except ValueError as e:
+                self.logger.error(f'{modulename} has invalid poll_cron, polling every {poll.interval} seconds: {e}')
+        if poll.cron:
+            poll.due = self.cron_due(poll, now)
+        else:
+            # Spread the first polls of modules over the jitter window
+            poll.due = now + random.uniform(0, poll.jitter)
+        self.push(poll)
+
+    def remove(self, modulename):
+        """Stop polling module. Returns its ScheduledPoll, or None if it wasn't scheduled."""
+        removed = None
+        heap = []
+        for entry in self.heap:
+            if entry[2].modulename == modulename:
+                removed = entry[2]
+            else:
+                heap.append(entry)
+        heapq.heapify(heap)
+        self.heap = heap
+        return removed
+
+    def push(self, poll):
+        heapq.heappush(self.heap, (poll.due, next(self.counter), poll))
+
+    def cron_due(self, poll, now):
+        wallclock = datetime.now()
+        delay = (poll.cron.next_time(wallclock) - wallclock).total_seconds()
+        return now + delay + random.uniform(0, poll.jitter)
+
+    def next_due(self):
+        """Loop time of the next due poll, or None if nothing is scheduled"""
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """Return polls that are due, and schedule their next polls"""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap)[2])
+        for poll in due:
+            poll.pollcount += 1
+            if poll.cron:
+                poll.due = self.cron_due(poll, now)
+            else:
+                # Keep a fixed cadence, but don't try to catch up on missed polls
+                poll.base = max(poll.base + poll.interval, now)
+                poll.due = poll.base + random.uniform(0, poll.jitter)
+            self.push(poll)
+        return due
+
+    def schedule(self, now):
+        """Return (modulename, interval or cron, seconds to next poll) for each scheduled module"""
+        return [(poll.modulename, poll.cron.expression if poll.cron else poll.interval, due - now)
+                for due, _, poll in sorted(self.heap)]
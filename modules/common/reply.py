@@ -0,0 +1,130 @@
+import json
+from html import escape
+
+# Homeservers reject events larger than 65536 bytes. Leave room for the rest of the event,
+# and for encryption which grows the content by a third.
+MAX_CONTENT_SIZE = 32 * 1024
+
+
+class Reply:
+    """Collects a reply from several parts and sends it as few events as possible
+
+    Text and html parts are joined with line breaks into one message, which is split into
+    several messages before it grows over max_size bytes. Images are sent as separate events,
+    in the order they were added. Create with Bot.reply().
+
+    Example:
+
+        reply = bot.reply(room)
+        for event in events:
+            reply.html(f'<b>{event.time}</b> {event.title}', f'{event.time} {event.title}')
+        await reply.send()
+    """
+
+    def __init__(self, bot, room, msgtype="m.notice", bot_ignore=False, max_size=MAX_CONTENT_SIZE):
+        self.bot = bot
+        self.room = room
+        self.msgtype = msgtype
+        self.bot_ignore = bot_ignore
+        self.max_size = max_size
+        self.parts = []  # ('text', body, None), ('html', plaintext, html) or ('image', args)
+
+    def text(self, body):
+        """Add a plain text part"""
+        self.parts.append(('text', str(body), None))
+        return self
+
+    def html(self, html, plaintext):
+        """Add a html part, with plaintext version of it"""
+        self.parts.append(('html', plaintext, html))
+        return self
+
+    def image(self, url, body, mimetype=None, width=None, height=None, size=None):
+        """Add an image, see Bot.send_image()"""
+        self.parts.append(('image', (url, body, mimetype, width, height, size), None))
+        return self
+
+    def __len__(self):
+        return len(self.parts)
+
+    @staticmethod
+    def encoded_size(text):
+        # Size as JSON string, counts escaping and non-ascii characters generously
+        return len(json.dumps(text)) if text else 0
+
+    def messages(self):
+        """Return the messages to send: ('text', body, html or None) and ('image', args) tuples"""
+        messages = []
+        bodies, htmls, size = [], [], 0
+        formatted = False
+
+        def flush():
+            if bodies:
+                html = '<br/>'.join(htmls) if formatted else None
+                messages.append(('text', '\n'.join(bodies), html))
+            bodies.clear()
+            htmls.clear()
+
+        for kind, body, html in self.parts:
+            if kind == 'image':
+                flush()
+                formatted = False
+                size = 0
+                messages.append(('image', body))
+                continue
+
+            if html is None:
+                html = escape(body).replace('\n', '<br/>')
+            part_size = self.encoded_size(body) + self.encoded_size(html)
+            if bodies and size + part_size > self.max_size:
+                flush()
+                formatted = False
+                size = 0
+
+            if part_size > self.max_size:
+                # Too large to send as one message. Html can't be split safely, so send it as plain text.
+                for chunk in self.split_text(body):
+                    messages.append(('text', chunk, None))
+                continue
+
+            bodies.append(body)
+            htmls.append(html)
+            formatted = formatted or kind == 'html'
+            size += part_size
+        flush()
+        return messages
+
+    def split_text(self, body):
+        """Split text into chunks that fit in a message, at line breaks if possible"""
+        chunks, chunk = [], ''
+        for line in body.splitlines(keepends=True):
+            while self.encoded_size(line) > self.max_size:
+                # Halving the limit leaves room for escaped characters
+                cut = self.max_size // 2
+                while cut > 1 and self.encoded_size(line[:cut]) > self.max_size:
+                    cut //= 2
+                if chunk:
+                    chunks.append(chunk)
+                    chunk = ''
+                chunks.append(line[:cut])
+                line = line[cut:]
+            if chunk and self.encoded_size(chunk + line) > self.max_size:
+                chunks.append(chunk)
+                chunk = ''
+            chunk += line
+        if chunk:
+            chunks.append(chunk)
+        return [chunk.rstrip('\n') for chunk in chunks]
+
+    async def send(self):
+        """Send the collected parts. Returns list of NIO Responses."""
+        responses = []
+        for message in self.messages():
+            if message[0] == 'image':
+                responses.append(await self.bot.send_image(self.room, *message[1]))
+            elif message[2] is None:
+                responses.append(await self.bot.send_text(self.room, message[1], self.msgtype, self.bot_ignore))
+            else:
+                responses.append(await self.bot.send_html(self.room, message[2], message[1], self.msgtype, self.bot_ignore))
+        self.parts = []
+        return responses
@@ -0,0 +1,193 @@
+import asyncio
+import collections
+import logging
+import uuid
+
+import aiohttp
+from nio import ErrorResponse
+
+
+class TokenBucket:
+    """Allows rate events per second on average, and bursts of up to burst events. Zero rate means no limit."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = 0.0
+        self.paused_until = 0.0
+
+    def wait_time(self, now):
+        """Seconds to wait until a token is available"""
+        wait = max(self.paused_until - now, 0)
+        if not self.rate:
+            return wait
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def idle(self, now):
+        """True if the bucket is full and not paused, so it's the same as a new one"""
+        if now < self.paused_until:
+            return False
+        return not self.rate or self.tokens + (now - self.updated) * self.rate >= self.burst
+
+    def pause(self, now, seconds):
+        self.paused_until = max(self.paused_until, now + seconds)
+
+
+class SendQueue:
+    """Sends room events to the homeserver, paced to stay within rate limits
+
+    Events are sent in order within each room by a worker task per room. Sending is paced
+    with a token bucket per room and one shared by all rooms, as homeservers rate limit
+    per user. When the homeserver responds with M_LIMIT_EXCEEDED, all sending pauses for
+    retry_after_ms. nio retries the rate limited request itself and calls on_rate_limited
+    as a response callback before waiting. Events that time out are retried with the same
+    transaction id, up to max_retries times.
+    """
+
+    def __init__(self, client, rate=5, burst=20, room_rate=1, room_burst=5, max_retries=3, timeout=60):
+        self.logger = logging.getLogger("hemppa.sendqueue")
+        self.client = client
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate, burst)
+        self.room_buckets = dict()  # Room id -> TokenBucket
+        self.queues = dict()  # Room id -> deque of (queued time, message type, content, future)
+        self.workers = dict()  # Room id -> worker task
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.rate_limited = 0  # M_LIMIT_EXCEEDED responses seen
+        self.throttle_wait = 0.0  # Seconds spent waiting for the token buckets
+        self.max_wait = 0.0  # Longest time an event has been queued
+
+    async def send(self, room_id, message_type, content):
+        """Queue an event and wait until it has been sent
+
+        :return: the NIO Response from room_send()
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.queues.setdefault(room_id, collections.deque()).append((loop.time(), message_type, content, future))
+        if room_id not in self.workers:
+            self.workers[room_id] = loop.create_task(self.run(room_id))
+        return await future
+
+    async def run(self, room_id):
+        loop = asyncio.get_event_loop()
+        queue = self.queues[room_id]
+        try:
+            while queue:
+                queued, message_type, content, future = queue.popleft()
+                try:
+                    response = await self.deliver(room_id, message_type, content)
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(response)
+                self.max_wait = max(self.max_wait, loop.time() - queued)
+        finally:
+            self.workers.pop(room_id, None)
+            if not queue:
+                self.queues.pop(room_id, None)
+
+    async def deliver(self, room_id, message_type, content):
+        # Same transaction id for all attempts, so the homeserver won't duplicate the event
+        tx_id = str(uuid.uuid4())
+        response = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.retries += 1
+            await self.wait_for_token(room_id)
+            try:
+                response = await asyncio.wait_for(self.client.room_send(room_id, message_type, content, tx_id=tx_id),
+                                                  self.timeout)
+            except (asyncio.TimeoutError, TimeoutError, aiohttp.ClientError) as e:
+                if attempt == self.max_retries:
+                    self.failed += 1
+                    self.logger.error(f'Failed to send event to {room_id}: {repr(e)}')
+                    raise
+                self.logger.warning(f'Failed to send event to {room_id}, retrying: {repr(e)}')
+                self.pause(2 ** attempt)
+                continue
+            if isinstance(response, ErrorResponse) and response.status_code == 'M_LIMIT_EXCEEDED':
+                await self.on_rate_limited(response)
+                continue
+            if isinstance(response, ErrorResponse):
+                self.failed += 1
+                self.logger.error(f'Failed to send event to {room_id}: {response}')
+            else:
+                self.sent += 1
+            return response
+
+        self.failed += 1
+        self.logger.error(f'Giving up sending event to {room_id} after {self.max_retries} retries')
+        return response
+
+    async def wait_for_token(self, room_id):
+        loop = asyncio.get_event_loop()
+        room_bucket = self.room_buckets.get(room_id)
+        if not room_bucket:
+            self.prune_buckets(loop.time())
+            room_bucket = self.room_buckets[room_id] = TokenBucket(self.room_rate, self.room_burst)
+        while True:
+            now = loop.time()
+            wait = max(self.bucket.wait_time(now), room_bucket.wait_time(now))
+            if wait <= 0:
+                self.bucket.take()
+                room_bucket.take()
+                return
+            self.throttle_wait += wait
+            await asyncio.sleep(wait)
+
+    def prune_buckets(self, now):
+        """Drop buckets of rooms not sent to lately, they would be full anyway"""
+        for room_id in [room_id for room_id, bucket in self.room_buckets.items()
+                        if room_id not in self.workers and bucket.idle(now)]:
+            del self.room_buckets[room_id]
+
+    def pause(self, seconds):
+        """Stop sending to all rooms for given number of seconds"""
+        self.bucket.pause(asyncio.get_event_loop().time(), seconds)
+
+    async def on_rate_limited(self, response):
+        """Response callback, pauses sending when the homeserver says we are rate limited"""
+        if response.status_code != 'M_LIMIT_EXCEEDED':
+            return
+        self.rate_limited += 1
+        retry_after = (response.retry_after_ms or 5000) / 1000
+        self.logger.warning(f'Rate limited by homeserver, pausing sending for {retry_after} seconds')
+        self.pause(retry_after)
+
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def stats(self):
+        return {
+            'queued': self.queued(),
+            'rooms': len(self.workers),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retries': self.retries,
+            'rate_limited': self.rate_limited,
+            'throttle_wait': self.throttle_wait,
+            'max_wait': self.max_wait,
+        }
+
+    def cancel(self):
+        for worker in list(self.workers.values()):
+            worker.cancel()
@@ -0,0 +1,37 @@
+import asyncio
+
+
+class SingleFlight:
+    """Runs identical concurrent calls only once
+
+    do(key, func, *args) awaits func(*args, **kwargs). If a call with the same key is already
+    running, it waits for that call instead and gets the same result or exception. The call
+    runs in its own task, so a caller that is cancelled doesn't cancel it for the others.
+    Results are not cached: a call made after the previous one finished runs again.
+    """
+
+    def __init__(self):
+        self.calls = dict()  # Key -> asyncio.Task
+        self.started = 0
+        self.shared = 0  # Calls that waited for a call already running
+
+    async def do(self, key, func, *args, **kwargs):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self.finished(key, done))
+            self.started += 1
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def finished(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            # Mark the exception retrieved, in case every caller was cancelled
+            task.exception()
+
+    def running(self):
+        return len(self.calls)
@@ -0,0 +1,121 @@
+import concurrent.futures
+import json
+import logging
+import os
+import sqlite3
+
+from nio import Event, MatrixRoom, RoomMemberEvent
+from nio.responses import RoomSummary
+
+
+class StateStore:
+    """Persistent store of sync state: sync token, and state events of joined rooms
+
+    Stored in a local SQLite database, so that after restart client.rooms can be restored
+    and sync continued incrementally, instead of doing a full initial sync.
+    Also stores small values, such as the m.direct account data.
+
+    Writes are done in a thread of their own, so the event loop doesn't wait for the disk.
+    They are done in the order they are made. Reads are only done at startup.
+    """
+
+    def __init__(self, path):
+        self.logger = logging.getLogger("hemppa.statestore")
+        self.path = path
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='hemppa-statestore')
+        self.db.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS rooms (room_id TEXT PRIMARY KEY, summary TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS state (room_id TEXT, type TEXT, state_key TEXT, event TEXT, '
+                        'PRIMARY KEY (room_id, type, state_key))')
+        self.db.commit()
+
+    def get(self, key):
+        row = self.db.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def write(self, func, *args):
+        future = self.writer.submit(func, *args)
+        future.add_done_callback(self.write_done)
+        return future
+
+    def write_done(self, future):
+        if not future.cancelled() and future.exception():
+            self.logger.error('Writing state store failed', exc_info=future.exception())
+
+    def set(self, key, value):
+        self.write(self.write_set, key, value)
+
+    def write_set(self, key, value):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO kv VALUES (?, ?)', (key, value))
+
+    def save_sync(self, response, rooms):
+        """Store state changes and token from a SyncResponse
+
+        :param rooms: the client's rooms (room id -> MatrixRoom), after the response has been handled
+        """
+        # Serialized here, as the rooms change when the next response is handled
+        state = []
+        summaries = []
+        for room_id, join_info in response.rooms.join.items():
+            events = list(join_info.state)
+            events.extend(event for event in join_info.timeline.events if 'state_key' in event.source)
+            state.extend((room_id, event.source['type'], event.source['state_key'], json.dumps(event.source))
+                         for event in events if 'type' in event.source)
+            room = rooms.get(room_id)
+            summary = room.summary if room else None
+            if summary:
+                summary = json.dumps([summary.invited_member_count, summary.joined_member_count, summary.heroes])
+            summaries.append((room_id, summary))
+        left = [(room_id,) for room_id in response.rooms.leave]
+        self.write(self.write_sync, state, summaries, left, response.next_batch)
+
+    def write_sync(self, state, summaries, left, next_batch):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)', state)
+            self.db.executemany('INSERT OR REPLACE INTO rooms VALUES (?, ?)', summaries)
+            self.db.executemany('DELETE FROM rooms WHERE room_id = ?', left)
+            self.db.executemany('DELETE FROM state WHERE room_id = ?', left)
+            self.db.execute('INSERT OR REPLACE INTO kv VALUES (?, ?)', ('next_batch', next_batch))
+
+    def restore_rooms(self, client):
+        """Recreate client.rooms from stored state. Returns number of rooms restored."""
+        rooms = dict()
+        for room_id, summary in self.db.execute('SELECT room_id, summary FROM rooms'):
+            room = rooms[room_id] = MatrixRoom(room_id, client.user_id)
+            if summary:
+                room.update_summary(RoomSummary(*json.loads(summary)))
+
+        for room_id, source in self.db.execute('SELECT room_id, event FROM state'):
+            room = rooms.get(room_id)
+            if not room:
+                continue
+            event = Event.parse_event(json.loads(source))
+            if isinstance(event, RoomMemberEvent):
+                room.handle_membership(event)
+            elif isinstance(event, Event):
+                room.handle_event(event)
+
+        for room in rooms.values():
+            if room.encrypted:
+                client.encrypted_rooms.add(room.room_id)
+        client.rooms.update(rooms)
+        return len(rooms)
+
+    def clear(self):
+        self.write(self.write_clear)
+
+    def write_clear(self):
+        with self.db:
+            self.db.execute('DELETE FROM kv')
+            self.db.execute('DELETE FROM rooms')
+            self.db.execute('DELETE FROM state')
+
+    def close(self):
+        # Finish pending writes first
+        self.writer.shutdown(wait=True)
+        self.db.close()
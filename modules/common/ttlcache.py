@@ -0,0 +1,47 @@
+import collections
+import time
+
+
+class TTLCache:
+    """In-memory cache whose entries expire after a time to live
+
+    Holds at most max_entries entries, the least recently used is dropped when full.
+    Each entry can have its own ttl (seconds), e.g. a shorter one for failures.
+    """
+
+    def __init__(self, max_entries=256, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # Key -> (expires, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def put(self, key, value, ttl=None):
+        self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,104 @@
+import collections
+
+import httpx
+
+DOMAIN_PREFIX = 'domain:'
+
+
+class SubstringMatcher:
+    """Aho-Corasick automaton finding any of a set of substrings in one pass over the text"""
+
+    def __init__(self, patterns):
+        self.transitions = [dict()]  # State -> {char -> state}
+        self.fail = [0]
+        self.output = [None]  # State -> pattern ending at it (or at its fail chain), or None
+        for pattern in patterns:
+            if pattern:
+                self.add(pattern)
+        self.build()
+
+    def add(self, pattern):
+        state = 0
+        for char in pattern:
+            next_state = self.transitions[state].get(char)
+            if next_state is None:
+                next_state = len(self.transitions)
+                self.transitions[state][char] = next_state
+                self.transitions.append(dict())
+                self.fail.append(0)
+                self.output.append(None)
+            state = next_state
+        if self.output[state] is None:
+            self.output[state] = pattern
+
+    def build(self):
+        queue = collections.deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.transitions[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.transitions[fail].get(char, 0)
+                if self.output[next_state] is None:
+                    self.output[next_state] = self.output[self.fail[next_state]]
+
+    def search(self, text):
+        """Return the first pattern found in text, or None"""
+        transitions, fail, output = self.transitions, self.fail, self.output
+        state = 0
+        for char in text:
+            while state and char not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(char, 0)
+            if output[state] is not None:
+                return output[state]
+        return None
+
+
+class UrlBlacklist:
+    """Blacklist of urls, compiled once for fast matching
+
+    Entries are substrings matched anywhere in the url, or domain:example.com to match
+    urls on example.com and all its subdomains. Matching takes the same time however
+    many entries there are.
+    """
+
+    def __init__(self, entries=()):
+        self.entries = list(entries)
+        self.domains = set()
+        substrings = []
+        for entry in self.entries:
+            if entry.startswith(DOMAIN_PREFIX):
+                domain = entry[len(DOMAIN_PREFIX):].strip('.').lower()
+                if domain:
+                    self.domains.add(domain)
+            else:
+                substrings.append(entry)
+        self.substrings = SubstringMatcher(substrings) if substrings else None
+
+    def domain_match(self, url):
+        try:
+            host = httpx.URL(url).host.lower().rstrip('.')
+        except Exception:
+            return None
+        labels = host.split('.')
+        for i in range(len(labels)):
+            domain = '.'.join(labels[i:])
+            if domain in self.domains:
+                return DOMAIN_PREFIX + domain
+        return None
+
+    def match(self, url):
+        """Return the entry url matches, or None if it's not blacklisted"""
+        if self.domains:
+            entry = self.domain_match(url)
+            if entry:
+                return entry
+        if self.substrings:
+            return self.substrings.search(url)
+        return None
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+
+class Watchdog:
+    """Detects when the event loop is blocked and finds out what is blocking it
+
+    A task on the event loop updates a heartbeat every interval seconds. A thread checks
+    the heartbeat, and when it hasn't been updated for threshold seconds, captures the
+    stack of the event loop thread. The stall is attributed to the innermost module in
+    the stack (a file in modules/), logged, and when the loop runs again, passed to
+    on_stall(module, seconds, stack).
+    """
+
+    def __init__(self, threshold=1.0, interval=0.25, on_stall=None):
+        self.logger = logging.getLogger("hemppa.watchdog")
+        self.threshold = threshold
+        self.interval = interval
+        self.on_stall = on_stall
+        self.beat = time.monotonic()
+        self.stall = None  # (module, stack) captured by the thread, for the current stall
+        self.reported = None  # Heartbeat of the last stall reported
+        self.loop_thread = None
+        self.task = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        self.stopped.clear()
+        self.task = asyncio.get_event_loop().create_task(self.heartbeat())
+        self.thread = threading.Thread(target=self.watch, name='hemppa-watchdog', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def heartbeat(self):
+        while True:
+            self.beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            stall = self.stall
+            if stall:
+                self.stall = None
+                module, stack = stall
+                seconds = time.monotonic() - self.beat - self.interval
+                self.log(module, logging.WARNING, f'Event loop was blocked for {seconds:.2f} seconds')
+                if self.on_stall:
+                    self.on_stall(module, seconds, stack)
+
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            beat = self.beat
+            blocked = time.monotonic() - beat
+            if blocked < self.threshold or self.reported == beat:
+                continue
+            self.reported = beat
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            module = self.module_of(stack)
+            self.stall = (module, stack)
+            self.log(module, logging.WARNING,
+                     f'Event loop blocked for over {blocked:.2f} seconds, in:\n' + ''.join(traceback.format_list(stack[-8:])))
+
+    @staticmethod
+    def module_of(stack):
+        """Name of the innermost bot module in stack, or None if it's not in a module"""
+        for frame in reversed(stack):
+            directory, filename = os.path.split(frame.filename)
+            if os.path.basename(directory) == 'modules' and filename.endswith('.py'):
+                return filename[:-3]
+        return None
+
+    def log(self, module, level, message):
+        # bot_module is used by !bot logs to file the message under the module
+        if module:
+            logging.getLogger("module " + module).log(level, message, extra={'bot_module': module})
+        else:
+            self.logger.log(level, message)
@@ -19,6 +19,7 @@ class MatrixModule(BotModule):
     def matrix_start(self, bot):
         super().matrix_start(bot)
         bot.module_aliases.update(self.aliases)
+        bot.update_commands()
 
     async def matrix_message(self, bot, room, event):
 
@@ -31,6 +32,7 @@ class MatrixModule(BotModule):
                 self.logger.debug(f"room: {room.name} sender: {event.sender} wants to add an alias")
 
                 bot.module_aliases.update({args[0]: args[1]})
+                bot.update_commands()
                 self.aliases.update({args[0]: args[1]})
                 bot.save_settings()
                 await bot.send_text(room, f'Aliased !{args[0]} to !{args[1]}')
@@ -41,6 +43,7 @@ class MatrixModule(BotModule):
                 self.logger.debug(f"room: {room.name} sender: {event.sender} wants to remove an alias")
 
                 old = bot.module_aliases.pop(args[0])
+                bot.update_commands()
                 self.aliases.pop(args[0])
                 bot.save_settings()
                 await bot.send_text(room, f'Removed alias !{args[0]}')
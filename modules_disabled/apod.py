@@ -1,7 +1,6 @@
 import os
 import re
 
-import requests
 from nio import AsyncClient, UploadError
 from nio import UploadResponse
 
@@ -36,8 +35,8 @@ class MatrixModule(BotModule):
         super().__init__(name)
         self.api_key = os.getenv("APOD_API_KEY", "DEMO_KEY")
         self.update_api_urls()
-        self.matrix_uri_cache = dict()
         self.APOD_DATE_PATTERN = r"^\d\d\d\d-\d\d-\d\d$"
+        self.APOD_IMAGE_PREFIXES = ("https://apod.nasa.gov/", "http://apod.nasa.gov/")
 
     def update_api_urls(self):
         self.apod_api_url = f"https://api.nasa.gov/planetary/apod?api_key={self.api_key}&hd=true"
@@ -80,24 +79,26 @@ class MatrixModule(BotModule):
 
     async def send_apod(self, bot, room, uri, set_room_avatar=False):
         self.logger.debug(f"send request using uri {uri}")
-        response = requests.get(uri)
+        response = await self.http.get(uri, cache=60 * 60)
         if response.status_code == 200:
             apod = Apod.create_from_json(response.json())
 
             self.logger.debug(apod)
             if apod.media_type == "image":
-                await bot.send_text(room, f"{apod.title} ({apod.date})")
+                reply = bot.reply(room)
+                reply.text(f"{apod.title} ({apod.date})")
                 mxc_details = bot.get_uri_cache(apod.hdurl)
                 try:
                     if not mxc_details:
                         mxc_details = await bot.upload_image(apod.hdurl)
                     matrix_uri, mimetype, w, h, size = mxc_details
-                    await bot.send_image(room, matrix_uri, apod.hdurl, mimetype, w, h, size)
+                    reply.image(matrix_uri, apod.hdurl, mimetype, w, h, size)
                     if set_room_avatar:
                         await bot.set_room_avatar(room, matrix_uri, mimetype, w, h, size)
                 except (UploadFailed, ValueError):
-                    await self.send_text(room, f"Something went wrong uploading {apod.hdurl}.")
-                await bot.send_text(room, f"{apod.explanation}")
+                    reply.text(f"Something went wrong uploading {apod.hdurl}.")
+                reply.text(f"{apod.explanation}")
+                await reply.send()
             else:
                 await self.send_unknown_mediatype(room, bot, apod)
         elif response.status_code == 400:
@@ -109,19 +110,18 @@ class MatrixModule(BotModule):
 
     async def send_unknown_mediatype(self, room, bot, apod):
         self.logger.debug(f"unknown media_type: {apod.media_type}. sending raw information")
-        await bot.send_text(room, f"{apod.title}")
-        await bot.send_text(room, f"{apod.explanation} || date: {apod.date} || original-url: {apod.url}")
+        reply = bot.reply(room)
+        reply.text(f"{apod.title}")
+        reply.text(f"{apod.explanation} || date: {apod.date} || original-url: {apod.url}")
+        await reply.send()
 
     def get_settings(self):
         data = super().get_settings()
-        data["matrix_uri_cache"] = self.matrix_uri_cache
         data["api_key"] = self.api_key
         return data
 
     def set_settings(self, data):
         super().set_settings(data)
-        if data.get("matrix_uri_cache"):
-            self.matrix_uri_cache = data["matrix_uri_cache"]
         if data.get("api_key"):
             self.api_key = data["api_key"]
             self.update_api_urls()
@@ -130,19 +130,20 @@ class MatrixModule(BotModule):
         return 'Sends latest Astronomy Picture of the Day to the room. (https://apod.nasa.gov/apod/astropix.html)'
 
     async def send_stats(self, bot, room):
-        msg = f"collected {len(self.matrix_uri_cache)} upload matrix uri's"
+        stats = bot.media_cache.stats()
+        msg = f"collected {stats['entries']} upload matrix uri's ({stats['hits']} hits, {stats['misses']} misses)"
         await bot.send_text(room, msg)
 
     async def clear_uri_cache(self, bot, room):
-        self.matrix_uri_cache.clear()
-        bot.save_settings()
-        await bot.send_text(room, "cleared uri cache")
+        # Only this module's images, the media cache is shared with other modules
+        count = sum(bot.media_cache.remove_prefix(prefix) for prefix in self.APOD_IMAGE_PREFIXES)
+        await bot.send_text(room, f"cleared {count} apod images from uri cache")
 
     async def command_help(self, bot, room):
         msg = """commands:
         - YYYY-MM-DD - date of the APOD image to retrieve (ex. 2020-03-15)
         - stats - show information about uri cache
-        - clear - clear uri cache (Must be done as owner)
+        - clear - clear APOD images from uri cache (Must be done as owner)
         - apikey [api-key] - set the nasa api key (Must be done as bot owner)
         - help - show command help
         - avatar, avatar YYYY-MM-DD - Additionally set the room's avatar to the fetched image (Must be done as admin)
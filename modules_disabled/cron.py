@@ -1,13 +1,16 @@
 import shlex
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from .common.module import BotModule
 
 
 class MatrixModule(BotModule):
     daily_commands = dict()  # room_id -> command json
-    last_hour = datetime.now().hour
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.poll_cron = '@hourly'
 
     async def matrix_message(self, bot, room, event):
         bot.must_be_admin(room, event)
@@ -49,17 +52,18 @@ class MatrixModule(BotModule):
 
     async def matrix_poll(self, bot, pollcount):
         delete_rooms = []
-        if self.last_hour != datetime.now().hour:
-            self.last_hour = datetime.now().hour
+        # Polled at the start of every hour. The poll may run a little before or after it,
+        # so run the commands of the nearest full hour.
+        hour = (datetime.now() + timedelta(minutes=30)).hour
 
-            for room_id in self.daily_commands:
-                if room_id in bot.client.rooms:
-                    commands = self.daily_commands[room_id]
-                    for command in commands:
-                        if int(command['time']) == self.last_hour:
-                            await bot.send_text(bot.get_room_by_id(room_id), command['command'], 'm.text')
-                else:
-                    delete_rooms.append(room_id)
+        for room_id in self.daily_commands:
+            if room_id in bot.client.rooms:
+                commands = self.daily_commands[room_id]
+                for command in commands:
+                    if int(command['time']) == hour:
+                        await bot.send_text(bot.get_room_by_id(room_id), command['command'], 'm.text')
+            else:
+                delete_rooms.append(room_id)
 
         for roomid in delete_rooms:
             self.daily_commands.pop(roomid, None)
@@ -1,19 +1,17 @@
+import asyncio
 from logging import log
 import sys
 import traceback
 import json
 import time
 import datetime
-import requests
-import urllib3
 
 from datetime import datetime, timedelta
 from random import randrange
 
+from modules.common.httpclient import HttpClient
 from modules.common.module import BotModule
 
-urllib3.disable_warnings()
-
 # API docs at: https://gitlab.com/lemoidului/ogn-flightbook/-/blob/master/doc/API.md
 class FlightBook:
     def __init__(self):
@@ -25,12 +23,10 @@ class FlightBook:
         self.logged_flights = dict() # station -> [index of flight]
         self.device_cache = dict() # Registration -> [address, CN]
 
-    def get_flights(self, icao):
+    async def get_flights(self, icao):
         log_url = f'{self.base_url}/logbook/{icao}'
-        data = None
-        with requests.Session() as session:
-            response = session.get(log_url, headers={'Connection': 'close'}, verify=False)
-            data = response.json()
+        response = await HttpClient.get_shared().get(log_url, verify=False)
+        data = response.json()
 
         # print(json.dumps(data, sort_keys=True, indent=4))
         self.update_device_cache(data)
@@ -87,7 +83,7 @@ class FlightBook:
 
     def test():
         fb = FlightBook()
-        data = fb.get_flights('LFMX')
+        data = asyncio.run(fb.get_flights('LFMX'))
         fb.print_flights(data)
 
 class MatrixModule(BotModule):
@@ -100,19 +96,20 @@ class MatrixModule(BotModule):
         self.first_poll = True
         self.enabled = False
         self.fb = FlightBook()
+        self.poll_interval = 5 * 60
+        self.poll_jitter = 60
 
     def matrix_start(self, bot):
         super().matrix_start(bot)
         self.add_module_aliases(bot, ['sar'])
 
     async def matrix_poll(self, bot, pollcount):
-        if pollcount % (6 * 5) == 0:  # Poll every 5 min
-            await self.poll_implementation(bot)
+        await self.poll_implementation(bot)
 
     async def poll_implementation(self, bot):
         for roomid in self.live_rooms:
             station = self.station_rooms[roomid]
-            data = self.fb.get_flights(station)
+            data = await self.fb.get_flights(station)
             if not data:
                 self.logger.warning(f"FLOG: Failed to get flights at {station}!")
                 return
@@ -188,7 +185,7 @@ class MatrixModule(BotModule):
 
             coords = None
             if address:
-                coords = self.get_coords_for_address(address)
+                coords = await self.get_coords_for_address(address)
             if coords:
                 await bot.send_location(room, f'{registration} ({coords["utc"]})', coords["lat"], coords["lng"])
             else:
@@ -206,13 +203,11 @@ class MatrixModule(BotModule):
                 await bot.send_text(room, f'Set OGN station {station} to this room')
 
 
-    def get_coords_for_address(self, address):
+    async def get_coords_for_address(self, address):
         # https://flightbook.glidernet.org/api/live/address/~91DADF5B86
         url = f'{self.fb.base_url}/live/address/{address}'
-        data = None
-        with requests.Session() as session:
-            response = session.get(url, headers={'Connection': 'close'}, verify=False)
-            data = response.json()
+        response = await self.http.get(url, verify=False)
+        data = response.json()
 
         # print(json.dumps(data, sort_keys=True, indent=4))
         return data
@@ -247,7 +242,7 @@ class MatrixModule(BotModule):
         return out
 
     async def show_flog(self, bot, room, station):
-        data = self.fb.get_flights(station)
+        data = await self.fb.get_flights(station)
         if data:
             await bot.send_html(room, self.html_flog(data, False), self.text_flog(data, False))
         else:
@@ -1,12 +1,9 @@
-import urllib.request
-import urllib.parse
-import urllib.error
-
-import requests
+import httpx
 from nio import AsyncClient, UploadError
 from nio import UploadResponse
 
 from collections import namedtuple
+from modules.common.httpclient import HttpClient
 from modules.common.module import BotModule
 
 class gfycat(object):
@@ -21,20 +18,19 @@ class gfycat(object):
     def __init__(self):
         super(gfycat, self).__init__()
 
-    def __fetch(self, url, param):
-        import json
+    async def __fetch(self, url, params):
         try:
             # added simple User-Ajent string to avoid CloudFlare block this request
             headers = {'User-Agent': 'Mozilla/5.0'}
-            req = urllib.request.Request(url+param, headers=headers)
-            connection = urllib.request.urlopen(req).read()
-        except urllib.error.HTTPError as err:
-            raise ValueError(err.read())
+            response = await HttpClient.get_shared().get(url, params=params, headers=headers, cache=60 * 60)
+            response.raise_for_status()
+        except httpx.HTTPStatusError as err:
+            raise ValueError(err.response.content)
         result = namedtuple("result", "raw json")
-        return result(raw=connection, json=json.loads(connection))
+        return result(raw=response.content, json=response.json())
 
-    def search(self, param):
-        result = self.__fetch(self.url, "/v1/gfycats/search?search_text=%s" % urllib.parse.quote_plus(param))
+    async def search(self, param):
+        result = await self.__fetch(self.url + "/v1/gfycats/search", {'search_text': param})
         if "errorMessage" in result.json:
             raise ValueError("%s" % self.json["errorMessage"])
         return _gfycatSearch(result)
@@ -83,7 +79,7 @@ class MatrixModule(BotModule):
             gif_url = "No image found"
             query = event.body[len(args[0])+1:]
             try:
-                gifs = gfycat().search(query)
+                gifs = await gfycat().search(query)
                 if len(gifs) < 1:
                     await bot.send_text(room, gif_url)
                     return
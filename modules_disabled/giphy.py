@@ -1,10 +1,4 @@
-import urllib.request
-import urllib.parse
-import urllib.error
-
 import os
-import giphypop
-import requests
 from nio import AsyncClient, UploadError
 from nio import UploadResponse
 
@@ -13,6 +7,7 @@ from modules.common.module import BotModule
 
 class MatrixModule(BotModule):
     api_key = None
+    search_url = 'https://api.giphy.com/v1/gifs/search'
 
     async def matrix_message(self, bot, room, event):
         args = event.body.split()
@@ -26,18 +21,15 @@ class MatrixModule(BotModule):
             gif_url = "No image found"
             query = event.body[len(args[0])+1:]
             try:
-                g = giphypop.Giphy(api_key=self.api_key)
-                gifs = []
-                try:
-                    for x in g.search(phrase=query, limit=1):
-                        gifs.append(x)
-                except Exception:
-                    pass
+                response = await self.http.get(self.search_url, params={'api_key': self.api_key, 'q': query, 'limit': 1},
+                                               cache=60 * 60)
+                response.raise_for_status()
+                gifs = response.json().get('data') or []
                 if len(gifs) < 1:
                     await bot.send_text(room, gif_url)
                     return
 
-                gif_url = gifs[0].media_url
+                gif_url = gifs[0]['images']['original']['url']
                 await bot.upload_and_send_image(room, gif_url)
                 return
             except Exception as exc:
@@ -1,5 +1,6 @@
 from __future__ import print_function
 
+import asyncio
 import os
 import os.path
 import pickle
@@ -32,11 +33,21 @@ class MatrixModule(BotModule):
     def matrix_start(self, bot):
         super().matrix_start(bot)
         self.bot = bot
-        creds = None
 
         if not os.path.exists(self.credentials_file) or os.path.getsize(self.credentials_file) == 0:
             return  # No-op if not set up
 
+        # Logging in may wait for the user, set up in background
+        asyncio.get_event_loop().create_task(self.setup_service())
+
+    async def setup_service(self):
+        try:
+            self.service = await self.run_blocking(self.build_service, timeout=600)
+        except Exception:
+            self.logger.exception('Setting up Google calendar failed!')
+
+    def build_service(self):
+        creds = None
         if os.path.exists('token.pickle'):
             with open('token.pickle', 'rb') as token:
                 creds = pickle.load(token)
@@ -55,15 +66,16 @@ class MatrixModule(BotModule):
                 pickle.dump(creds, token)
                 self.logger.info('Pickle saved')
 
-        self.service = build('calendar', 'v3', credentials=creds)
+        service = build('calendar', 'v3', credentials=creds)
 
         try:
-            calendar_list = self.service.calendarList().list().execute()['items']
+            calendar_list = service.calendarList().list().execute()['items']
             self.logger.info(f'Google calendar set up successfully with access to {len(calendar_list)} calendars:\n')
             for calendar in calendar_list:
                 self.logger.info(f"{calendar['summary']} - + {calendar['id']}")
         except Exception:
             self.logger.error('Getting calendar list failed!')
+        return service
 
     async def matrix_message(self, bot, room, event):
         if not self.service:
@@ -77,7 +89,7 @@ class MatrixModule(BotModule):
             if args[1] == 'today':
                 for calid in calendars:
                     self.logger.info(f'Listing events in cal {calid}')
-                    events = events + self.list_today(calid)
+                    events = events + await self.run_blocking(self.list_today, calid)
             if args[1] == 'list':
                 await bot.send_text(room, 'Calendars in this room: ' + str(self.calendar_rooms.get(room.room_id)))
                 return
@@ -124,7 +136,7 @@ class MatrixModule(BotModule):
         else:
             for calid in calendars:
                 self.logger.info(f'Listing events in cal {calid}')
-                events = events + self.list_upcoming(calid)
+                events = events + await self.run_blocking(self.list_upcoming, calid)
 
         if len(events) > 0:
             self.logger.info(f'Found {len(events)} events')
@@ -134,10 +146,12 @@ class MatrixModule(BotModule):
             await bot.send_text(room, 'No events found, try again later :)')
 
     async def send_events(self, bot, events, room):
+        reply = bot.reply(room)
         for event in events:
             start = event['start'].get('dateTime', event['start'].get('date'))
-            await bot.send_html(room, f'{self.parse_date(start)} <a href="{event["htmlLink"]}">{event["summary"]}</a>',
-                                f'{self.parse_date(start)} {event["summary"]}')
+            reply.html(f'{self.parse_date(start)} <a href="{event["htmlLink"]}">{event["summary"]}</a>',
+                       f'{self.parse_date(start)} {event["summary"]}')
+        await reply.send()
 
     def list_upcoming(self, calid):
         startTime = datetime.utcnow()
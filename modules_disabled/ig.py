@@ -19,15 +19,16 @@ class MatrixModule(PollingService):
 
     async def poll_implementation(self, bot, account, roomid, send_messages):
         try:
-            medias = self.instagram.get_medias(account, 5)
+            medias = await self.coalesce(account, self.run_blocking, self.instagram.get_medias, account, 5)
             self.logger.info(f'Polling instagram account {account} for room {roomid} - got {len(medias)} posts.')
+            reply = bot.reply(bot.get_room_by_id(roomid))
             for media in medias:
                 if send_messages:
                     if media.identifier not in self.known_ids:
-                        await bot.send_html(bot.get_room_by_id(roomid),
-                                            f'<a href="{media.link}">Instagram {account}:</a> {media.caption}',
-                                            f'{account}: {media.caption} {media.link}')
+                        reply.html(f'<a href="{media.link}">Instagram {account}:</a> {media.caption}',
+                                   f'{account}: {media.caption} {media.link}')
                 self.known_ids.add(media.identifier)
+            await reply.send()
 
         except InstagramNotFoundException:
             self.logger.error(f"{account} does not exist - deleting from room")
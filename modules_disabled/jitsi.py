@@ -1,4 +1,4 @@
-from nio import RoomMessageUnknown, UnknownEvent
+from nio import RoomMessageUnknown
 
 from modules.common.module import BotModule
 
@@ -9,11 +9,14 @@ class MatrixModule(BotModule):
     def matrix_start(self, bot):
         super().matrix_start(bot)
         self.bot = bot
-        bot.client.add_event_callback(self.unknownevent_cb, (UnknownEvent,))
+        bot.subscribe(self.unknownevent_cb, 'im.vector.modular.widgets', owner=self.name)
+
+    def sync_event_types(self):
+        return ['im.vector.modular.widgets']
 
     def matrix_stop(self, bot):
         super().matrix_stop(bot)
-        bot.remove_callback(self.unknownevent_cb)
+        bot.unsubscribe(self.unknownevent_cb)
 
     async def unknownevent_cb(self, room, event):
         try:
@@ -10,11 +10,11 @@ class MatrixModule(BotModule):
     def matrix_start(self, bot):
         super().matrix_start(bot)
         self.bot = bot
-        bot.client.add_event_callback(self.unknown_cb, RoomMessageUnknown)
+        bot.subscribe(self.unknown_cb, RoomMessageUnknown, owner=self.name)
 
     def matrix_stop(self, bot):
         super().matrix_stop(bot)
-        bot.remove_callback(self.unknown_cb)
+        bot.unsubscribe(self.unknown_cb)
 
     async def unknown_cb(self, room, event):
         if event.msgtype != 'm.location':
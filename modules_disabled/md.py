@@ -28,11 +28,7 @@ class MatrixModule(BotModule):
                     accesstoken = self.logins[event.sender][1]
                     instanceurl = self.logins[event.sender][2]
                 if accesstoken:
-                    toottodon = Mastodon(
-                        access_token = accesstoken,
-                        api_base_url = instanceurl
-                    )
-                    tootdict = toottodon.toot(toot_body)
+                    tootdict = await self.run_blocking(self.toot, accesstoken, instanceurl, toot_body)
                     await bot.send_text(room, tootdict['url'])
                 else:
                     await bot.send_text(room, f'{event.sender} has not logged in yet with the bot. Please do so.')
@@ -108,14 +104,27 @@ class MatrixModule(BotModule):
 
     async def register_app_if_necessary(self, bot, room, instanceurl):
         if not instanceurl in self.apps.keys():
-            app = Mastodon.create_app(f'Hemppa The Bot - {bot.client.user}', api_base_url = instanceurl)
+            app = await self.run_blocking(Mastodon.create_app, f'Hemppa The Bot - {bot.client.user}', api_base_url = instanceurl)
             self.apps[instanceurl] = [app[0], app[1]]
             bot.save_settings()
             await bot.send_text(room, f'Registered Mastodon app on {instanceurl}')
 
+    @staticmethod
+    def toot(accesstoken, instanceurl, toot_body):
+        toottodon = Mastodon(
+            access_token = accesstoken,
+            api_base_url = instanceurl
+        )
+        return toottodon.toot(toot_body)
+
+    @staticmethod
+    def log_in(client_id, client_secret, instanceurl, username, password):
+        mastodon = Mastodon(client_id = client_id, client_secret = client_secret, api_base_url = instanceurl)
+        return mastodon.log_in(username, password)
+
     async def login_to_account(self, bot, room, mxid, roomid, instanceurl, username, password):
-        mastodon = Mastodon(client_id = self.apps[instanceurl][0], client_secret = self.apps[instanceurl][1], api_base_url = instanceurl)
-        access_token = mastodon.log_in(username, password)
+        access_token = await self.run_blocking(self.log_in, self.apps[instanceurl][0], self.apps[instanceurl][1],
+                                               instanceurl, username, password)
         print('login_To_account', mxid, roomid)
         if mxid:
             self.logins[mxid] = [username, access_token, instanceurl]
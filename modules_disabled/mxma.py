@@ -1,5 +1,5 @@
 from modules.common.module import BotModule
-import requests, json
+import sys
 import traceback
 
 from modules.common.pollingservice import PollingService
@@ -16,7 +16,7 @@ class MatrixModule(PollingService):
 
     async def poll_implementation(self, bot, account, roomid, send_messages):
         try:
-            response = requests.get(url=account, timeout=5)
+            response = await self.http.get(account, timeout=5)
             if response.status_code == 200:
                 if 'messages' in response.json():
                     messages = response.json()['messages']
@@ -1,10 +1,10 @@
+from modules.common.httpclient import HttpClient
 from modules.common.module import BotModule
 from nio import RoomMessageMedia
 from typing import Optional
 import sys
 import traceback
 import cups
-import httpx
 import asyncio
 import aiofiles
 import os
@@ -13,14 +13,12 @@ import os
 async def download_file(url: str, filename: Optional[str] = None) -> str:
     filename = filename or url.split("/")[-1]
     filename = f"/tmp/{filename}"
-    client = httpx.AsyncClient()
-    async with client.stream("GET", url) as resp:
+    async with HttpClient.get_shared().stream("GET", url) as resp:
         resp.raise_for_status()
         async with aiofiles.open(filename, "wb") as f:
             async for data in resp.aiter_bytes():
                 if data:
                     await f.write(data)
-    await client.aclose()
     return filename
 
 class MatrixModule(BotModule):
@@ -28,6 +26,7 @@ class MatrixModule(BotModule):
         super().__init__(name)
         self.printers = dict() # roomid <-> printername
         self.bot = None
+        self.subscription = None
         self.paper_size = 'A4' # Todo: configurable
         self.enabled = False
 
@@ -53,14 +52,19 @@ class MatrixModule(BotModule):
                 traceback.print_exc(file=sys.stderr)
                 await self.bot.send_text(room, f'Printing failed, sorry. See log for details.')
 
+    def update_subscription(self):
+        if self.subscription:
+            self.bot.set_subscription_rooms(self.subscription, self.printers.keys())
+
     def matrix_start(self, bot):
         super().matrix_start(bot)
-        bot.client.add_event_callback(self.file_cb, RoomMessageMedia)
         self.bot = bot
+        self.subscription = bot.subscribe(self.file_cb, RoomMessageMedia, rooms=self.printers.keys(), owner=self.name)
 
     def matrix_stop(self, bot):
         super().matrix_stop(bot)
-        bot.remove_callback(self.file_cb)
+        bot.unsubscribe(self.file_cb)
+        self.subscription = None
         self.bot = None
 
     async def matrix_message(self, bot, room, event):
@@ -83,6 +87,7 @@ class MatrixModule(BotModule):
                 await bot.send_text(room, msg)
             elif args[0] == 'rmroomprinter':
                 del self.printers[room.room_id]
+                self.update_subscription()
                 await bot.send_text(room, f'Deleted printer from this room.')
                 bot.save_settings()
 
@@ -92,6 +97,7 @@ class MatrixModule(BotModule):
                 if printer in printers:
                     await bot.send_text(room, f'Printing with {printer} here.')
                     self.printers[room.room_id] = printer
+                    self.update_subscription()
                     bot.save_settings()
                 else:
                     await bot.send_text(room, f'No printer called {printer} in your CUPS.')
@@ -113,5 +119,6 @@ class MatrixModule(BotModule):
         super().set_settings(data)
         if data.get("printers"):
             self.printers = data["printers"]
+            self.update_subscription()
         if data.get("paper_size"):
             self.paper_size = data["paper_size"]
@@ -1,24 +1,21 @@
 from typing import Text
-import urllib
-import urllib.request
-from urllib.parse import urlencode, quote_plus
-import json
 import time 
 
+from modules.common.httpclient import HttpClient
 from modules.common.module import BotModule
 
 class PeerTubeClient:
     def __init__(self):
         self.instance_url = 'https://sepiasearch.org/'
 
-    def search(self, search_string, count=0):
+    async def search(self, search_string, count=0):
         if count == 0:
             count = 15 # Pt default, could also remove from params..
-        params = urlencode({'search': search_string, 'count': count}, quote_via=quote_plus)
-        search_url = self.instance_url + 'api/v1/search/videos?' + params
-        response = urllib.request.urlopen(search_url)
-        data = json.loads(response.read().decode("utf-8"))
-        return data
+        search_url = self.instance_url + 'api/v1/search/videos'
+        response = await HttpClient.get_shared().get(search_url, params={'search': search_string, 'count': count},
+                                                     cache=10 * 60)
+        response.raise_for_status()
+        return response.json()
 
 class MatrixModule(BotModule):
     def __init__(self, name):
@@ -51,15 +48,17 @@ class MatrixModule(BotModule):
             count = 1
             if args[0] == '!ptall':
                 count = 0
-            data = p.search(query, count)
+            data = await p.search(query, count)
             if len(data['data']) > 0:
+                reply = bot.reply(room, bot_ignore=True)
                 for video in data['data']:
                     video_url = video.get("url") or self.instance_url + 'videos/watch/' + video["uuid"]
                     duration = time.strftime('%H:%M:%S', time.gmtime(video["duration"]))
                     instancedata = video["account"]["host"]
                     html = f'<a href="{video_url}">{video["name"]}</a> {video["description"] or ""} [{duration}] @ {instancedata}'
                     text = f'{video_url} : {video["name"]} {video.get("description") or ""} [{duration}]'
-                    await bot.send_html(room, html, text, bot_ignore=True)
+                    reply.html(html, text)
+                await reply.send()
             else:
                     await bot.send_text(room, 'Sorry, no videos found found.', bot_ignore=True)
 
@@ -5,7 +5,9 @@ class MatrixModule(BotModule):
     def __init__(self, name):
         super().__init__(name)
         self.bridges = dict()
+        self.targets = dict()  # Room id -> room id it's bridged to, both ways
         self.bot = None
+        self.subscription = None
         self.enabled = False
 
     async def message_cb(self, room, event):
@@ -15,18 +17,8 @@ class MatrixModule(BotModule):
         if event.body.startswith('!'):
             return
 
-        source_id = None
-        target_id = None
-
-        for src_id, tgt_id in self.bridges.items():
-            if room.room_id == src_id:
-                source_id = src_id
-                target_id = tgt_id
-            elif room.room_id == tgt_id:
-                source_id = tgt_id
-                target_id = src_id
-
-        if not source_id or not target_id:
+        target_id = self.targets.get(room.room_id)
+        if not target_id:
             return
 
         target_room = self.bot.get_room_by_id(target_id)
@@ -38,14 +30,22 @@ class MatrixModule(BotModule):
         else:
             self.logger.warning(f"Bot doesn't seem to be in bridged room {target_id}")
 
+    def update_subscription(self):
+        """Call when bridges have changed"""
+        self.targets = dict((tgt_id, src_id) for src_id, tgt_id in self.bridges.items())
+        self.targets.update(self.bridges)
+        if self.subscription:
+            self.bot.set_subscription_rooms(self.subscription, self.targets.keys())
+
     def matrix_start(self, bot):
         super().matrix_start(bot)
-        bot.client.add_event_callback(self.message_cb, RoomMessageText)
         self.bot = bot
+        self.subscription = bot.subscribe(self.message_cb, RoomMessageText, rooms=self.targets.keys(), owner=self.name)
 
     def matrix_stop(self, bot):
         super().matrix_stop(bot)
-        bot.remove_callback(self.message_cb)
+        bot.unsubscribe(self.message_cb)
+        self.subscription = None
         self.bot = None
 
     async def matrix_message(self, bot, room, event):
@@ -81,6 +81,7 @@ class MatrixModule(BotModule):
                 if room_to_bridge:
                     await bot.send_text(room, f'Bridging {room_to_bridge.display_name} here.')
                     self.bridges[room.room_id] = roomid
+                    self.update_subscription()
                     bot.save_settings()
                 else:
                     await bot.send_text(room, f'I am not on room with id {roomid} (note: use id, not alias)!')
@@ -90,6 +91,7 @@ class MatrixModule(BotModule):
                 for src_id, tgt_id in self.bridges.items():
                     if i == idx:
                         del self.bridges[src_id]
+                        self.update_subscription()
                         await bot.send_text(room, f'Unbridged {src_id} and {tgt_id}.')
                         bot.save_settings()
                         return
@@ -107,3 +109,4 @@ class MatrixModule(BotModule):
         super().set_settings(data)
         if data.get("bridges"):
             self.bridges = data["bridges"]
+            self.update_subscription()
@@ -1,6 +1,5 @@
+from modules.common.httpclient import HttpClient
 from modules.common.pollingservice import PollingService
-from urllib.request import urlopen
-import json
 import time
 
 class MatrixModule(PollingService):
@@ -12,7 +11,7 @@ class MatrixModule(PollingService):
 
     async def poll_implementation(self, bot, account, roomid, send_messages):
         self.logger.debug(f'polling space api {account}.')
-        spacename, is_open = MatrixModule.open_status(account)
+        spacename, is_open = await self.coalesce(account, MatrixModule.open_status, account)
 
         open_str = self.i18n['open'] if is_open else self.i18n['closed']
         text = self.template.format(spacename=spacename, open_closed=open_str)
@@ -25,9 +24,10 @@ class MatrixModule(PollingService):
             bot.save_settings()
 
     @staticmethod
-    def open_status(spaceurl):
-        with urlopen(spaceurl, timeout=5) as response:
-            js = json.load(response)
+    async def open_status(spaceurl):
+        response = await HttpClient.get_shared().get(spaceurl, timeout=5, cache=True)
+        response.raise_for_status()
+        js = response.json()
 
         return js['space'], js['state']['open']
 
@@ -1,11 +1,8 @@
-import urllib.request
-import urllib.parse
-import urllib.error
 import datetime
+import httpx
 import pytz
 import os
 import sys
-import json
 
 import importlib
 from importlib import reload
@@ -183,9 +180,9 @@ class MatrixModule(BotModule):
 
             try:
                 url = "{}/api/v2?apikey={}&cmd=get_recently_added&count=10".format(os.getenv("TAUTULLI_URL"), self.api_key)
-                req = urllib.request.Request(url+"&media_type="+media_type)
-                connection = urllib.request.urlopen(req).read()
-                entries = json.loads(connection)
+                response = await self.http.get(url+"&media_type="+media_type)
+                response.raise_for_status()
+                entries = response.json()
                 if "response" not in entries and "data" not in entries["response"] and "recently_added" not in entries["response"]["data"]:
                     await bot.send_text(room, "no recently added for %s" % media_type)
                     return
@@ -193,8 +190,8 @@ class MatrixModule(BotModule):
                 for entry in entries["response"]["data"]["recently_added"]:
                     await send_entry(bot, room, entry) 
 
-            except urllib.error.HTTPError as err:
-                raise ValueError(err.read())
+            except httpx.HTTPStatusError as err:
+                raise ValueError(err.response.content)
             except Exception as exc:
                 message = str(exc)
                 await bot.send_text(room, message)
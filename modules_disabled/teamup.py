@@ -16,19 +16,21 @@ class MatrixModule(BotModule):
         self.calendar_rooms = dict()  # Roomid -> [calid, calid..]
         self.calendars = dict()  # calid -> Calendar
         self.enabled = False
+        self.poll_interval = 5 * 60
+        self.poll_jitter = 60
 
     async def matrix_poll(self, bot, pollcount):
         if self.api_key:
-            if pollcount % (6 * 5) == 0:  # Poll every 5 min
-                await self.poll_all_calendars(bot)
+            await self.poll_all_calendars(bot)
 
     async def matrix_message(self, bot, room, event):
         args = event.body.split()
         if len(args) == 1:
             if self.calendar_rooms.get(room.room_id):
+                reply = bot.reply(room)
                 for calendarid in self.calendar_rooms.get(room.room_id):
                     calendar = self.calendars[calendarid]
-                    events = calendar.get_event_collection()
+                    events = await self.run_blocking(calendar.get_event_collection)
                     for event in events:
                         s = '<b>' + str(event.start_dt.day) + \
                             '.' + str(event.start_dt.month)
@@ -38,7 +40,8 @@ class MatrixModule(BotModule):
                                     "%H:%M") + ' (' + str(event.duration) + ' min)'
                         s = s + '</b> ' + event.title + \
                             " " + (event.notes or '')
-                        await bot.send_html(room, s, s)
+                        reply.html(s, s)
+                await reply.send()
         elif len(args) == 2:
             if args[1] == 'list':
                 await bot.send_text(room, f'Calendars in this room: {self.calendar_rooms.get(room.room_id) or []}')
@@ -96,12 +99,13 @@ class MatrixModule(BotModule):
         for roomid in self.calendar_rooms:
             if roomid in bot.client.rooms:
                 calendars = self.calendar_rooms[roomid]
+                reply = bot.reply(bot.get_room_by_id(roomid))
                 for calendarid in calendars:
-                    events, timestamp = self.poll_server(
-                        self.calendars[calendarid])
+                    events, timestamp = await self.run_blocking(self.poll_server, self.calendars[calendarid])
                     self.calendars[calendarid].timestamp = timestamp
                     for event in events:
-                        await bot.send_text(bot.get_room_by_id(roomid), 'Calendar: ' + self.eventToString(event))
+                        reply.text('Calendar: ' + self.eventToString(event))
+                await reply.send()
             else:
                 delete_rooms.append(roomid)
 
@@ -1,14 +1,16 @@
+import asyncio
 import re
 import shlex
-from functools import lru_cache
 
 import httpx
 import sys
 import traceback
-from bs4 import BeautifulSoup
 from nio import RoomMessageText
 
+from modules.common.htmlhead import HeadExtractor
 from modules.common.module import BotModule
+from modules.common.ttlcache import TTLCache
+from modules.common.urlblacklist import UrlBlacklist
 
 
 class MatrixModule(BotModule):
@@ -22,6 +24,7 @@ class MatrixModule(BotModule):
         super().__init__(name)
 
         self.bot = None
+        self.subscription = None
         self.status = dict()  # room_id -> what to do with urls
         self.type = "m.notice"  # notice or text
         # this will be extended when matrix_start is called
@@ -34,15 +37,30 @@ class MatrixModule(BotModule):
             "BOTH": "Spamming this channel with both title and description",
         }
         self.blacklist = [ ]
+        self.blacklist_matcher = UrlBlacklist()  # Compiled from blacklist, rebuilt when it changes
         self.enabled = False
+        self.cache_ttl = 60 * 60  # Seconds to remember titles
+        self.failure_ttl = 5 * 60  # Seconds to remember urls that could not be fetched
+        self.domain_limit = 2  # Max urls fetched from one domain at a time
+        self.content_cache = TTLCache(max_entries=512, ttl=self.cache_ttl)  # Normalized url -> (title, description)
+        self.domain_semaphores = dict()  # Domain -> [asyncio.Semaphore, fetches using it], while in use
+        self.tasks = set()  # Running send_titles() tasks
+
+    def active_rooms(self):
+        return [room_id for room_id, status in self.status.items() if status in self.STATUSES and status != "OFF"]
+
+    def update_subscription(self):
+        if self.subscription:
+            self.bot.set_subscription_rooms(self.subscription, self.active_rooms())
 
     def matrix_start(self, bot):
         """
-        Register callback for all RoomMessageText events on startup
+        Subscribe to RoomMessageText events containing urls in rooms where we are on
         """
         super().matrix_start(bot)
         self.bot = bot
-        bot.client.add_event_callback(self.text_cb, RoomMessageText)
+        self.subscription = bot.subscribe(self.text_cb, RoomMessageText, rooms=self.active_rooms(),
+                                          regex=r"https?://", owner=self.name)
         # extend the useragent string to contain version and bot name
         self.useragent = f"Mozilla/5.0 (compatible; Hemppa/{self.bot.version}; {self.bot.client.user}; +https://github.com/vranki/hemppa/)"
         self.logger.debug(f"useragent: {self.useragent}")
@@ -50,7 +68,10 @@ class MatrixModule(BotModule):
 
     def matrix_stop(self, bot):
         super().matrix_stop(bot)
-        bot.remove_callback(self.text_cb)
+        bot.unsubscribe(self.text_cb)
+        self.subscription = None
+        for task in list(self.tasks):
+            task.cancel()
 
     def user_agent_for_url(self, url):
         if ('youtube.com' in url) or ('youtu.be' in url) or ('google.com' in url):
@@ -69,7 +90,7 @@ class MatrixModule(BotModule):
 
     async def text_cb(self, room, event):
         """
-        Handle client callbacks for all room text events
+        Handle room text events with urls
         """
         if self.bot.should_ignore_event(event):
             return
@@ -95,38 +116,46 @@ class MatrixModule(BotModule):
         if status == "OFF":
             return
 
-        try:
-            # extract possible urls from message
-            urls = re.findall(r"(https?://\S+)", event.body)
-
-            # no urls, nothing to do
-            if len(urls) == 0:
-                return
-
-            # fetch the urls and if we can see a title spit it out
-            for url in urls:
-                # fix for #98 a bit ugly, but skip all matrix.to urls
-                # those are 99.99% pills and should not
-                # spam the channel with matrix.to titles
-                if url.startswith("https://matrix.to/#/"):
-                    self.logger.debug(f"Skipping matrix.to url (#98): {url}")
-                    continue
+        # extract possible urls from message
+        urls = re.findall(r"(https?://\S+)", event.body)
+
+        fetch_urls = []
+        for url in urls:
+            # fix for #98 a bit ugly, but skip all matrix.to urls
+            # those are 99.99% pills and should not
+            # spam the channel with matrix.to titles
+            if url.startswith("https://matrix.to/#/"):
+                self.logger.debug(f"Skipping matrix.to url (#98): {url}")
+                continue
+
+            blacklisted = self.blacklist_matcher.match(url)
+            if blacklisted:
+                self.logger.debug(f"Skipping blacklisted url {url} ({blacklisted})")
+                continue
+            fetch_urls.append(url)
+
+        # no urls, nothing to do
+        if len(fetch_urls) == 0:
+            return
 
-                url_blacklisted = False
-                for blacklisted in self.blacklist:
-                    if blacklisted in url:
-                        url_blacklisted = True
-                if url_blacklisted:
-                    self.logger.debug(f"Skipping blacklisted url {url}")
-                    continue
+        # Fetch in a task of its own, so the sync loop isn't waiting for slow sites
+        task = asyncio.get_event_loop().create_task(self.send_titles(room, status, fetch_urls))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
 
-                try:
-                    title, description = self.get_content_from_url(url)
-                except Exception as e:
-                    self.logger.warning(f"could not fetch url: {e}")
-                    traceback.print_exc(file=sys.stderr)
+    async def send_titles(self, room, status, urls):
+        """
+        Fetch urls concurrently and if we can see a title spit it out, in the order of the message
+        """
+        try:
+            results = await asyncio.gather(*[self.get_content_from_url(url) for url in urls],
+                                           return_exceptions=True)
+            for url, result in zip(urls, results):
+                if isinstance(result, Exception):
+                    self.logger.warning(f"could not fetch url {url}: {result}")
                     # failed fetching, give up
                     continue
+                title, description = result
 
                 msg = ""
 
@@ -145,26 +174,73 @@ class MatrixModule(BotModule):
 
                 if msg.strip(): # Evaluates to true on non-empty strings
                     await self.bot.send_text(room, msg, msgtype=self.type, bot_ignore=True)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            self.logger.warning(f"Unexpected error in url module text_cb: {e}")
+            self.logger.warning(f"Unexpected error in url module send_titles: {e}")
             traceback.print_exc(file=sys.stderr)
 
-    @lru_cache(maxsize=128)
-    def get_content_from_url(self, url):
+    @staticmethod
+    def normalize_url(url):
+        """
+        Cache key for url: scheme and host in lowercase, without the fragment
+        """
+        try:
+            return str(httpx.URL(url).copy_with(fragment=None))
+        except Exception:
+            return url
+
+    @staticmethod
+    def url_domain(url):
+        try:
+            return httpx.URL(url).host
+        except Exception:
+            return url
+
+    async def get_content_from_url(self, url):
+        """
+        Return (title, description) of url, from cache if it has been fetched recently
+        """
+        key = self.normalize_url(url)
+        content = self.content_cache.get(key)
+        if content is not None:
+            return content
+        # concurrent messages with the same url share one fetch
+        return await self.coalesce(key, self.fetch_content, key, url)
+
+    async def fetch_content(self, key, url):
+        # limit fetches per domain, and forget the domain when nothing is fetched from it
+        domain = self.url_domain(url)
+        slot = self.domain_semaphores.get(domain)
+        if slot is None:
+            slot = self.domain_semaphores[domain] = [asyncio.Semaphore(self.domain_limit), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                title, description, ok = await self.fetch_content_from_url(url)
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self.domain_semaphores[domain]
+        self.content_cache.put(key, (title, description), ttl=self.cache_ttl if ok else self.failure_ttl)
+        return title, description
+
+    async def fetch_content_from_url(self, url):
         """
         Fetch url and try to get the title and description from the response
+
+        Returns (title, description, ok), ok is False if the url could not be fetched
         """
         title = None
         description = None
         # timeout will still handle network timeouts
         timeout = httpx.Timeout(10.0)
-        responsetext = ""  # read our response here
         try:
             self.logger.debug(f"start streaming {url}")
-            # stream the response so that we can set a upper limit on how much we want to fetch.
-            # as we are using stream the r.text wont be available, save our read data ourself
+            # stream the response and parse it as it comes in, so that we can stop
+            # reading as soon as the head of the document has been read
 
-            # maximum size to read of the response in characters (this prevents us from reading stream forever)
+            # maximum size to read of the response in bytes (this prevents us from reading stream forever)
             maxsize = 800000
             headers = {
                 'user-agent': self.user_agent_for_url(url)
@@ -174,57 +250,37 @@ class MatrixModule(BotModule):
             # cookies = self.cookies_for_url(url)
             # print('cookies', url, cookies)
             # print('headers', headers)
-            with httpx.stream("GET", url, timeout=timeout, headers=headers) as r:
-                for part in r.iter_text():
-                    # self.logger.debug(
-                    #     f"reading response stream, limiting in {maxsize} bytes"
-                    # )
-
-                    responsetext += part
+            async with self.http.stream("GET", url, timeout=timeout, headers=headers) as r:
+                if r.status_code != 200:
+                    self.logger.warning(
+                        f"Failed fetching url {url}. Status code: {r.status_code}"
+                    )
+                    return (title, description, False)
+
+                extractor = HeadExtractor(r.headers.get("content-type"))
+                async for part in r.aiter_bytes():
                     maxsize -= len(part)
-
-                    if maxsize < 0:
+                    if extractor.feed(part) or maxsize < 0:
                         break
 
             self.logger.debug(f"end streaming {url}")
         except Exception as e:
             self.logger.warning(f"Failed fetching url {url}. Error: {e}")
-            return (title, description)
+            return (title, description, False)
 
-        if r.status_code != 200:
-            self.logger.warning(
-                f"Failed fetching url {url}. Status code: {r.status_code}"
-            )
-            return (title, description)
-
-        # try parse and get the title
+        # get the title and description from what was read
         try:
-            soup = BeautifulSoup(responsetext, "html.parser")
-
-            if soup.title and len(soup.title.string) > 0:
-                title = soup.title.string
-            else:
-                title_tag = soup.find("meta", attrs={"name": "title"})
-                ogtitle = soup.find("meta", property="og:title")
-                if title_tag:
-                    title = title_tag.get("content", None)
-                elif ogtitle:
-                    title = ogtitle["content"]
-                elif soup.head and soup.head.title:
-                    title = soup.head.title.string.strip()
-            descr_tag = soup.find("meta", attrs={"name": "description"})
-            if descr_tag:
-                description = descr_tag.get("content", None)
+            title, description = extractor.close()
         except Exception as e:
             self.logger.warning(f"Failed parsing response from url {url}. Error: {e}")
-            return (title, description)
+            return (title, description, False)
 
         # Title should not contain newlines or tabs
         if title is not None:
             assert isinstance(title, str)
             title = title.replace("\n", "")
             title = title.replace("\t", "")
-        return (title, description)
+        return (title, description, True)
 
     async def matrix_message(self, bot, room, event):
         """
@@ -238,6 +294,7 @@ class MatrixModule(BotModule):
         # save the new status
         if len(args) == 1 and self.STATUSES.get(args[0].upper()) is not None:
             self.status[room.room_id] = args[0].upper()
+            self.update_subscription()
             bot.save_settings()
             await bot.send_text(
                 room, f"Ok, {self.STATUSES.get(self.status[room.room_id])}"
@@ -275,6 +332,7 @@ class MatrixModule(BotModule):
                 self.blacklist = []
             else:
                 self.blacklist = args[1].split(',')
+            self.blacklist_matcher = UrlBlacklist(self.blacklist)
             bot.save_settings()
             await bot.send_text(room, f"Blacklisted URLs set to {self.blacklist}")
             return
@@ -298,10 +356,12 @@ class MatrixModule(BotModule):
         super().set_settings(data)
         if data.get("status"):
             self.status = data["status"]
+            self.update_subscription()
         if data.get("type"):
             self.type = data["type"]
         if data.get("blacklist"):
             self.blacklist = data["blacklist"]
+            self.blacklist_matcher = UrlBlacklist(self.blacklist)
 
     def help(self):
         return "If I see a url in a message I will try to get the title from the page and spit it out"
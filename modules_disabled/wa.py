@@ -29,7 +29,7 @@ class MatrixModule(BotModule):
 
             query = event.body[len(args[0])+1:]
             client = wolframalpha.Client(self.app_id)
-            res = client.query(query)
+            res = await self.run_blocking(client.query, query)
             result = "?SYNTAX ERROR"
             if res['@success']:
                 self.logger.debug(f"room: {room.name} sender: {event.sender} sent a valid query to wa")
@@ -1,7 +1,6 @@
 import os
 import itertools
 import shlex
-import requests
 from modules.common.module import BotModule
 
 
@@ -28,7 +27,7 @@ class MatrixModule(BotModule):
         #   ["welcome_message", "query_host", "settings"]
         if args[0] == "welcome_message":
             welcome_settings = {"user_query_host": os.getenv("MATRIX_SERVER")}
-            users = self.get_server_user_list()
+            users = await self.get_server_user_list()
             welcome_settings.update({
                 "last_server_user_count": len(users),
                 "last_server_users": users,
@@ -51,7 +50,7 @@ class MatrixModule(BotModule):
             self.welcome_settings = data["welcome_settings"]
 
     async def matrix_poll(self, bot, pollcount):
-        server_user_delta = self.get_server_user_delta(bot)
+        server_user_delta = await self.get_server_user_delta(bot)
 
         # The first time this bot runs it will detect all users as new, so
         # allow it to one once without taking action.
@@ -107,12 +106,12 @@ class MatrixModule(BotModule):
             "recently_added": recently_added
         }
 
-    def get_server_user_delta(self, bot):
+    async def get_server_user_delta(self, bot):
         """
         Get the full user list for the server and return the change in users
         since the last run.
         """
-        user_list = self.get_server_user_list()
+        user_list = await self.get_server_user_list()
         user_delta = self.get_user_list_delta(
             user_list,
             self.welcome_settings["last_server_users"]
@@ -122,8 +121,8 @@ class MatrixModule(BotModule):
         bot.save_settings()
         return user_delta
 
-    def get_server_user_list(self):
-        user_data = requests.get(
+    async def get_server_user_list(self):
+        user_data = await self.http.get(
             self.welcome_settings["user_query_host"] + "/_synapse/admin/v2/users",
             headers={"Authorization": "Bearer {token}".format(
                 token=self.access_token